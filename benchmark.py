@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import builder
+
+# Opening hours, duration range (minutes) and cost range for each category
+categories = {
+    'food': (builder.time(11), builder.time(22), (45, 90), (800, 3000)),
+    'coffee': (builder.time(7), builder.time(20), (30, 60), (400, 900)),
+    'cultural': (builder.time(6), builder.time(17), (60, 120), (0, 500)),
+    'museum': (builder.time(9, 30), builder.time(17), (90, 180), (500, 2000)),
+    'park': (builder.time(5), builder.time(23), (60, 150), (0, 300)),
+    'shopping': (builder.time(10), builder.time(21), (30, 120), (0, 0)),
+    'observatory': (builder.time(10), builder.time(22), (60, 90), (1000, 3500)),
+}
+
+
+class Catalog(object):
+    """A synthetic set of stations, routes between all of them and
+    activities near them."""
+
+    def __init__(self, num_activities, num_stations, seed=0):
+        rng = random.Random(seed)
+        self.stations = ["Station {}".format(index)
+                         for index in range(num_stations)]
+        positions = [(rng.uniform(0, 20), rng.uniform(0, 20))
+                     for _ in self.stations]
+        # (from, to, minutes, cost, transfers), once per pair of stations
+        self.routes = []
+        for a in range(num_stations):
+            for b in range(a + 1, num_stations):
+                distance = ((positions[a][0] - positions[b][0]) ** 2 +
+                            (positions[a][1] - positions[b][1]) ** 2) ** 0.5
+                minutes = int(5 + distance * 2)
+                self.routes.append((a, b, minutes, 140 + minutes * 10,
+                                    minutes // 20))
+        # (title, station, category, opens, closes, minutes, cost)
+        self.activities = []
+        names = sorted(categories)
+        for index in range(num_activities):
+            category = rng.choice(names)
+            opens, closes, minutes, cost = categories[category]
+            self.activities.append((
+                "Activity {}".format(index),
+                rng.randrange(num_stations),
+                category,
+                opens,
+                closes,
+                rng.randint(*minutes) // 15 * 15,
+                rng.randint(*cost) // 10 * 10,
+            ))
+
+    def builder_activities(self):
+        matrix = builder.TravelMatrix(range(len(self.stations)), self.stations)
+        for a, b, minutes, cost, transfers in self.routes:
+            matrix.set_route(a, b, minutes, cost, transfers)
+        builder.travel_matrix = matrix
+        return [builder.Activity(title=title,
+                                 location=builder.Station(self.stations[station]),
+                                 duration=datetime.timedelta(minutes=minutes),
+                                 cost=cost,
+                                 available_from=opens,
+                                 available_until=closes,
+                                 category=category)
+                for title, station, category, opens, closes, minutes, cost
+                in self.activities]
+
+    def django_activities(self, generate_tours):
+        # Unsaved model instances, the search never touches the database
+        jst = datetime.timezone(datetime.timedelta(hours=9))
+        train_rides = {}
+        for index, (a, b, minutes, cost, transfers) in enumerate(self.routes):
+            train_ride = generate_tours.TrainRide(
+                id=index + 1, from_station_id=a + 1, to_station_id=b + 1,
+                cost=cost, transfers=transfers,
+                duration=datetime.timedelta(minutes=minutes))
+            for key in train_ride.directions():
+                train_rides[key] = train_ride
+        generate_tours.train_rides = train_rides
+        stations = [generate_tours.Station(id=index + 1,
+                                           location_ptr_id=index + 1,
+                                           name=name, station_id=index)
+                    for index, name in enumerate(self.stations)]
+        activities = []
+        for index, (title, station, category, opens, closes, minutes,
+                    cost) in enumerate(self.activities):
+            activity = generate_tours.Activity(
+                id=index + 1, title=title, cost=cost,
+                train_station=stations[station],
+                available_from=opens.replace(tzinfo=jst),
+                available_until=closes.replace(tzinfo=jst),
+                duration=datetime.timedelta(minutes=minutes))
+            activities.append(activity)
+        return activities
+
+
+def builder_specs():
+    # The same specifications as builder.py's main
+    specs = builder.Specifications(num_people=1, start_time=datetime.time(8, 0))
+    specs.set_max_cost(100000)
+    specs.set_min_end_time(datetime.time(16, 0))
+    specs.set_max_end_time(datetime.time(17, 0))
+    return specs
+
+
+def run_builder(catalog, args):
+    activities = catalog.builder_activities()
+    specs = builder_specs()
+
+    started = time.perf_counter()
+    first = builder.TourSearch(specs, activities, compact=True)
+    first_tour = None
+    if next(first.iter_paths(), None) is not None:
+        first_tour = time.perf_counter() - started
+
+    search = builder.TourSearch(specs, activities, compact=True)
+    started = time.perf_counter()
+    tours = search.run(args.time_limit)
+    seconds = time.perf_counter() - started
+    return {
+        'tours': len(tours),
+        'nodes': search.stats.nodes_explored,
+        'seconds': seconds,
+        'first_tour_seconds': first_tour,
+        'complete': search.complete,
+    }
+
+
+def run_generate_tours(catalog, args):
+    generate_tours = import_generate_tours()
+    activities = catalog.django_activities(generate_tours)
+
+    class TimedBestTours(generate_tours.BestTours):
+        first_tour = None
+
+        def push(self, score, tour):
+            if self.first_tour is None:
+                self.first_tour = time.perf_counter()
+            super(TimedBestTours, self).push(score, tour)
+
+    best = TimedBestTours(args.best, args.max_nodes)
+    started = time.perf_counter()
+    # As generate_subtree, but sharing one node budget
+    for index in range(len(activities)):
+        if best.out_of_nodes():
+            break
+        tour = generate_tours.TourProto()
+        remaining = list(activities)
+        if tour.add_activity(remaining.pop(index)):
+            generate_tours.build_tours(best, tour, remaining)
+    seconds = time.perf_counter() - started
+    first_tour = None
+    if best.first_tour is not None:
+        first_tour = best.first_tour - started
+    return {
+        'tours': best.found,
+        'nodes': best.nodes,
+        'seconds': seconds,
+        'first_tour_seconds': first_tour,
+        'complete': not best.out_of_nodes(),
+    }
+
+
+def import_generate_tours():
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'website'))
+    import generate_tours
+    return generate_tours
+
+
+engines = {
+    'builder': run_builder,
+    'generate_tours': run_generate_tours,
+}
+
+
+def peak_memory(engine, catalog, args):
+    # A second run, tracemalloc slows the search down too much to time it
+    tracemalloc.start()
+    try:
+        engines[engine](catalog, args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    results = []
+    for engine in args.engines:
+        for size in args.sizes:
+            catalog = Catalog(size, args.stations, args.seed)
+            result = {'engine': engine, 'activities': size,
+                      'stations': args.stations}
+            result.update(engines[engine](catalog, args))
+            result['nodes_per_second'] = result['nodes'] / result['seconds']
+            result['tours_per_second'] = result['tours'] / result['seconds']
+            if args.memory:
+                result['peak_memory_bytes'] = peak_memory(engine, catalog, args)
+            print_result(result)
+            results.append(result)
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'options': {'sizes': args.sizes, 'stations': args.stations,
+                    'seed': args.seed, 'time_limit': args.time_limit,
+                    'best': args.best, 'max_nodes': args.max_nodes},
+        'results': results,
+    }
+
+
+def print_result(result):
+    first_tour = result['first_tour_seconds']
+    print("{:>15} {:>4} activities: {:>8} tours {:>9} nodes {:8.3f}s "
+          "{:>10.0f} nodes/s, first tour {}{}".format(
+              result['engine'], result['activities'], result['tours'],
+              result['nodes'], result['seconds'], result['nodes_per_second'],
+              "-" if first_tour is None else "{:.4f}s".format(first_tour),
+              "" if result['complete'] else " (stopped)"))
+
+
+def compare(old, new):
+    # Speed of new relative to old for the runs they have in common
+    old_results = {(x['engine'], x['activities'], x['stations']): x
+                   for x in old['results']}
+    print("Compared with {}:".format(old['commit']))
+    for result in new['results']:
+        key = (result['engine'], result['activities'], result['stations'])
+        if key in old_results:
+            print("{:>15} {:>4} activities: {:.2f}x nodes/s".format(
+                key[0], key[1], result['nodes_per_second'] /
+                old_results[key]['nodes_per_second']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the tour searches on synthetic activities")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 15, 20],
+                        metavar='N', help="numbers of activities to try")
+    parser.add_argument('--stations', type=int, default=8,
+                        help="number of stations (default: 8)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engines', nargs='+', choices=sorted(engines),
+                        default=sorted(engines))
+    parser.add_argument('--time-limit', type=float, default=10.0,
+                        help="seconds before builder gives up (default: 10)")
+    parser.add_argument('--best', type=int, default=100, metavar='K',
+                        help="tours kept by generate_tours (default: 100)")
+    parser.add_argument('--max-nodes', type=int, default=5000,
+                        help="node budget of generate_tours (default: 5000)")
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="skip measuring peak memory")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', metavar='JSON',
+                        help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -1,13 +1,28 @@
 #!/usr/bin/python3
 
-import copy
+from array import array
+import argparse
+import asyncio
+import cProfile
+import concurrent.futures
 import csv
 import datetime
+import heapq
 import itertools
 import json
 import os
-import sqlite3
+import sys
+import threading
 import time
+from time import monotonic, perf_counter
+
+import snapshot
+import transit_db
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 # TODO:
@@ -21,9 +36,6 @@ import time
 path_transit_database = "tokyo-transit.db"
 path_activities = "activities.csv"
 
-conn = sqlite3.connect(path_transit_database)
-c = conn.cursor()
-
 ref_date = datetime.date(1970, 1, 1)
 
 
@@ -35,6 +47,7 @@ def time(hours, minutes=0, seconds=0):
 day_start = time(0)
 day_end = time(23, 59, 59)
 minimum_event_duration = datetime.timedelta(minutes=15)
+meet_duration = datetime.timedelta(minutes=15)
 
 meal_times = {
     'breakfast': {
@@ -54,6 +67,44 @@ meal_times = {
         'end': time(17, 0)
     }
 }
+meal_names = list(meal_times.keys())
+day_minutes = 24 * 60
+
+
+def to_minutes(value, round_up=False):
+    # Whole minutes in a timedelta, or since day_start for a datetime
+    if not isinstance(value, datetime.timedelta):
+        value = value - day_start
+    minutes, remainder = divmod(value, datetime.timedelta(minutes=1))
+    if round_up and remainder:
+        minutes += 1
+    return minutes
+
+
+def build_meal_slots(meal_types):
+    # The first of meal_types had at each minute of the day, as its bit in
+    # meal_names, for minutes strictly between the meal's start and end
+    slots = bytearray(day_minutes)
+    for meal_type in reversed(meal_types):
+        start = to_minutes(meal_times[meal_type]['start'])
+        end = to_minutes(meal_times[meal_type]['end'], round_up=True)
+        for minute in range(max(0, start + 1), min(end, day_minutes)):
+            slots[minute] = 1 << meal_names.index(meal_type)
+    return slots
+
+
+# The meal had at each minute of the day by food and coffee activities
+meal_slots = {
+    'food': build_meal_slots(meal_names),
+    'coffee': build_meal_slots(['coffee']),
+}
+coffee_meal = 1 << meal_names.index('coffee')
+coffee_end = to_minutes(meal_times['coffee']['end'], round_up=True)
+meet_minutes = to_minutes(meet_duration)
+# Below this many activities NumPy costs more per node than it saves
+vector_min_activities = 100
+# Nodes explored between checks of a search's deadline
+deadline_check_nodes = 1024
 
 
 def load_csv(csv_path):
@@ -92,6 +143,7 @@ def load_activities(path_activities):
         "Station Valid": None
     }
     data = parse_csv(path_activities, keys)
+    get_travel_matrix(set(activity['station'] for activity in data))
     activities = []
     for activity in data:
         activities.append(Activity(location=Station(activity['station']),
@@ -104,6 +156,64 @@ def load_activities(path_activities):
     return activities
 
 
+def input_version():
+    """The size and modification time of the activities and the transit
+    database, which a snapshot records to tell whether it is out of date."""
+    version = []
+    for path in (path_activities, path_transit_database):
+        try:
+            stat = os.stat(path)
+            version.append("{}:{}".format(stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            version.append("-")
+    return " ".join(version)
+
+
+def write_snapshot(path, activities):
+    """Compile the activities and the travel matrix of their stations into
+    a snapshot file for load_snapshot."""
+    matrix = get_travel_matrix()
+    names = [""] * matrix.size
+    for name, index in matrix.name_to_index.items():
+        if not names[index]:
+            names[index] = name
+    tz = snapshot.epoch.tzinfo
+    snapshot.write(
+        path, matrix.station_ids, names, matrix.minutes, matrix.costs,
+        matrix.transfers,
+        ((index + 1, activity.location.index, activity.location.name,
+          activity.title, activity.category, activity.cost, activity.duration,
+          activity.available_from.replace(tzinfo=tz),
+          activity.available_until.replace(tzinfo=tz))
+         for index, activity in enumerate(activities)),
+        source=input_version())
+
+
+def load_snapshot(path, check=True):
+    """The activities of a snapshot file, which also becomes the travel
+    matrix. Unless check is False, the snapshot must have been made from
+    the activities and transit database as they are now."""
+    global travel_matrix
+    snap = snapshot.Snapshot(path, verify=check)
+    if check and snap.source != input_version():
+        raise ValueError("{} is out of date, make it again with "
+                         "--write-snapshot".format(path))
+    travel_matrix = SnapshotTravelMatrix(path, snap)
+    activities = []
+    for (activity_id, index, station, title, category, cost, duration,
+         available_from, available_until) in snap.activities():
+        activities.append(Activity(location=Station(station),
+                                   duration=duration,
+                                   title=title,
+                                   cost=cost,
+                                   available_from=available_from.replace(
+                                       tzinfo=None),
+                                   available_until=available_until.replace(
+                                       tzinfo=None),
+                                   category=category))
+    return activities
+
+
 def cost_string(cost):
     return "free" if cost == 0 else "¥‎{}".format(cost)
 
@@ -120,6 +230,139 @@ def duration_string(duration):
         return "{}m".format(minutes)
 
 
+class TravelMatrix(object):
+    """Dense station-to-station travel times, costs and transfers.
+
+    The matrices are flat arrays of size * size entries indexed by
+    from_index * size + to_index, where the index of a station is its
+    position in station_ids.
+    """
+    unreachable = 0xFFFF
+
+    def __init__(self, station_ids, station_names):
+        self.id_to_index = {}
+        self.name_to_index = {}
+        for station_id, name in zip(station_ids, station_names):
+            index = self.id_to_index.setdefault(station_id,
+                                                len(self.id_to_index))
+            self.name_to_index.setdefault(name, index)
+        self.size = len(self.id_to_index)
+        self.station_ids = array('l', self.id_to_index.keys())
+        cells = self.size * self.size
+        self.minutes = array('H', [self.unreachable]) * cells
+        self.costs = array('H', [0]) * cells
+        self.transfers = array('B', [0]) * cells
+        for index in range(self.size):
+            self.minutes[index * self.size + index] = 0
+
+    @classmethod
+    def from_database(cls, db, station_names=None):
+        """The matrix of a TransitDatabase, only between the stations named
+        in station_names if it's given."""
+        if station_names is None:
+            stations = [(int(station_id), name)
+                        for station_id, name in db.stations()]
+        else:
+            station_ids = db.get_station_ids(station_names)
+            stations = [(station_ids[name], name)
+                        for name in sorted(station_ids)]
+        matrix = cls([row[0] for row in stations], [row[1] for row in stations])
+        if station_names is None:
+            routes = db.routes()
+        else:
+            ids = list(matrix.id_to_index)
+            found = db.get_routes((a, b) for a in ids for b in ids if a != b)
+            # Found for each direction, so each is set on its own
+            routes = (pair + route + (True,) for pair, route in found.items())
+        for from_id, to_id, mins, cost, transfers, one_way in routes:
+            from_index = matrix.id_to_index.get(int(from_id))
+            to_index = matrix.id_to_index.get(int(to_id))
+            if from_index is None or to_index is None:
+                continue
+            matrix.set_route(from_index, to_index, int(mins), int(cost),
+                             int(transfers), bool(one_way))
+        return matrix
+
+    def set_route(self, from_index, to_index, mins, cost, transfers,
+                  one_way=False):
+        # Routes are stored once per station pair, so fill both directions.
+        # Keep the first route seen for a pair, as a SELECT ... fetchone would.
+        # A one way route replaces the route in its direction.
+        if one_way:
+            if from_index != to_index:
+                cell = from_index * self.size + to_index
+                self.minutes[cell] = mins
+                self.costs[cell] = cost
+                self.transfers[cell] = transfers
+            return
+        for a, b in ((from_index, to_index), (to_index, from_index)):
+            cell = a * self.size + b
+            if a != b and self.minutes[cell] == self.unreachable:
+                self.minutes[cell] = mins
+                self.costs[cell] = cost
+                self.transfers[cell] = transfers
+
+    def index(self, name):
+        return self.name_to_index[name]
+
+    def route(self, from_index, to_index):
+        cell = from_index * self.size + to_index
+        if self.minutes[cell] == self.unreachable:
+            return None
+        return self.minutes[cell], self.costs[cell], self.transfers[cell]
+
+
+class SnapshotTravelMatrix(TravelMatrix):
+    """The read-only TravelMatrix of a snapshot file.
+
+    Its matrices are the pages of the mapped file, shared by every process
+    that maps it. It's pickled as its path, so process pool workers map the
+    file rather than being sent a copy.
+    """
+
+    def __init__(self, path, snap=None):
+        self.path = os.path.abspath(path)
+        if snap is None:
+            snap = snapshot.Snapshot(self.path, verify=False)
+        self.snapshot = snap
+        self.size = len(snap.station_ids)
+        self.station_ids = snap.station_ids
+        self.id_to_index = {station_id: index
+                            for index, station_id in enumerate(snap.station_ids)}
+        self.name_to_index = {}
+        for index, name in enumerate(snap.station_names):
+            if snap.string(name):
+                self.name_to_index.setdefault(snap.string(name), index)
+        for activity in snap.activities():
+            self.name_to_index.setdefault(activity[2], activity[1])
+        self.minutes = snap.minutes
+        self.costs = snap.costs
+        self.transfers = snap.transfers
+
+    def __reduce__(self):
+        return SnapshotTravelMatrix, (self.path,)
+
+
+travel_matrix = None
+# With more stations than this, the matrix only has the stations of the
+# activities, looked up as they're needed
+max_matrix_stations = 2000
+
+
+def get_travel_matrix(station_names=None):
+    global travel_matrix
+    if travel_matrix is None:
+        db = transit_db.TransitDatabase(path_transit_database)
+        try:
+            if station_names is not None and \
+                    db.station_count() <= max_matrix_stations:
+                station_names = None
+            travel_matrix = TravelMatrix.from_database(db, station_names)
+        finally:
+            db.close()
+    return travel_matrix
+
+
 class Location(object):
     def __init__(self, name):
         self.name = name
@@ -129,25 +372,17 @@ class Location(object):
 
 
 class Station(Location):
-    request_template = '''
-        SELECT station_id
-        FROM stations
-        WHERE english = "{}"
-    '''
 
     def __init__(self, name):
         super(Station, self).__init__(name)
-        self.id = self.get_station_id(name)
-
-    def get_station_id(self, name):
-        request = self.request_template.format(self.name)
-        c.execute(request)
-        res = c.fetchone()
-        if res is not None:
-            return int(res[0])
-        else:
-            raise
-            return None
+        self.index = self.get_station_index(name)
+        self.id = get_travel_matrix().station_ids[self.index]
+
+    def get_station_index(self, name):
+        try:
+            return get_travel_matrix().index(name)
+        except KeyError:
+            raise ValueError("Unknown station {}".format(name))
 
     def __str__(self):
         return "{} Station".format(self.name)
@@ -162,10 +397,15 @@ class Specifications(object):
     min_duration = None
     num_people = None
     start_time = None
+    # The same limits in whole minutes, for the search
+    start_minutes = None
+    max_minutes = None
+    min_minutes = None
 
     def __init__(self, num_people=1, start_time=datetime.time(8, 0)):
         self.num_people = num_people
         self.start_time = datetime.datetime.combine(ref_date, start_time)
+        self.start_minutes = to_minutes(self.start_time)
 
     def set_max_cost(self, cost):
         self.max_cost = cost
@@ -176,10 +416,12 @@ class Specifications(object):
     def set_max_end_time(self, max_end_time):
         self.max_end_time = datetime.datetime.combine(ref_date, max_end_time)
         self.max_duration = self.max_end_time - self.start_time
+        self.max_minutes = to_minutes(self.max_duration)
 
     def set_min_end_time(self, min_end_time):
         self.min_end_time = datetime.datetime.combine(ref_date, min_end_time)
         self.min_duration = self.min_end_time - self.start_time
+        self.min_minutes = to_minutes(self.min_duration, round_up=True)
 
     def too_expensive(self, cost):
         return self.max_cost is not None and cost > self.max_cost
@@ -205,6 +447,15 @@ class Specifications(object):
     def within_spec(self, cost, duration):
         return self.above_minimum(cost, duration) and self.below_maximum(cost, duration)
 
+    def below_maximum_minutes(self, cost, minutes):
+        return (self.max_cost is None or cost <= self.max_cost) \
+            and (self.max_minutes is None or minutes <= self.max_minutes)
+
+    def within_spec_minutes(self, cost, minutes):
+        return self.below_maximum_minutes(cost, minutes) \
+            and (self.min_cost is None or cost >= self.min_cost) \
+            and (self.min_minutes is None or minutes >= self.min_minutes)
+
 
 def to_time(input, default=day_start):
     if input is None or input == '':
@@ -260,7 +511,7 @@ class Meet(Event):
     def __init__(self, location):
         super(Meet, self).__init__(title=location.name,
                                    location=location,
-                                   duration=datetime.timedelta(minutes=15),
+                                   duration=meet_duration,
                                    cost=0,
                                    category="meet")
 
@@ -281,22 +532,30 @@ class Activity(Event):
     def __init__(self, title, location, duration, cost,
                  available_from=day_start, available_until=day_end,
                  category=None):
+        # The search works in whole minutes, so the duration is rounded to
+        # one for the tours it finds to replay the same
+        minutes = round(duration / datetime.timedelta(minutes=1))
+        duration = datetime.timedelta(minutes=minutes)
         super(Activity, self).__init__(title, location, duration, cost)
         self.available_from = available_from
         self.available_until = available_until
         self.category = category
+        # Opening window and duration in minutes since day_start
+        self.opens = to_minutes(available_from, round_up=True)
+        self.closes = to_minutes(available_until)
+        self.minutes = minutes
+        self.meal_slots = meal_slots.get(category)
+
+    def meal_at(self, minute):
+        if self.meal_slots is None or not 0 <= minute < day_minutes:
+            return 0
+        return self.meal_slots[minute]
 
     def meal_category(self, time):
-        if self.category == 'food':
-            for meal_type in meal_times.keys():
-                if time > meal_times[meal_type]['start'] \
-                        and time < meal_times[meal_type]['end']:
-                    return meal_type
-        elif self.category == 'coffee':
-            if time > meal_times['coffee']['start'] \
-                    and time < meal_times['coffee']['end']:
-                return 'coffee'
-        return False
+        meal = self.meal_at(to_minutes(time))
+        if meal == 0:
+            return False
+        return meal_names[meal.bit_length() - 1]
 
     def __str__(self):
         return self.title
@@ -321,27 +580,16 @@ class TrainRide(Transport):
         self.calculate()
 
     def calculate(self):
-        request_template = '''
-          SELECT from_id,
-                 to_id,
-                 mins,
-                 cost,
-                 transfers
-          FROM routes
-          WHERE from_id = "{}"
-          AND to_id = "{}";
-        '''
-        stations = [self.location.id, self.destination.id]
-        stations.sort()
-        request = request_template.format(*stations)
-        c.execute(request)
-        res = c.fetchone()
+        res = get_travel_matrix().route(self.location.index,
+                                        self.destination.index)
         if res is None:
             print("Cant find link between stations")
-            raise
+            raise LookupError("No route from {} to {}".format(
+                self.location, self.destination))
         else:
-            self.duration = datetime.timedelta(minutes=res[2])
-            self.cost = res[3]
+            self.duration = datetime.timedelta(minutes=res[0])
+            self.cost = res[1]
+            self.transfers = res[2]
 
     def __str__(self):
         return "Ride {} -> {}".format(self.location, self.destination)
@@ -391,7 +639,7 @@ class Tour(object):
         self.specs = specs
         self.included_meals = {}
 
-    def _add_event(self, event):
+    def push_event(self, event):
         if type(event) == Activity:
             meal = event.meal_category(self.end_time)
             index = len(self.events)
@@ -402,8 +650,24 @@ class Tour(object):
         self.end_time += event.duration
         self.events.append(event)
 
+    def pop_event(self):
+        event = self.events.pop()
+        self.included_meals.pop(len(self.events), None)
+        self.cost -= event.cost
+        self.duration -= event.duration
+        self.end_time -= event.duration
+        return event
+
     def add_activity(self, event):
-        success = False
+        mark = len(self.events)
+        if self._add_activity(event):
+            return True
+        # A failed add may have left the meet & greet behind
+        while len(self.events) > mark:
+            self.pop_event()
+        return False
+
+    def _add_activity(self, event):
         last_event = self.events[-1] if len(self.events) > 0 else None
         cost = self.cost + event.cost
         duration = self.duration + event.duration
@@ -435,15 +699,15 @@ class Tour(object):
         # Check if transport is required
         if last_event is None:
             # Add the first meet & greet
-            self._add_event(Meet(event.location))
+            self.push_event(Meet(event.location))
             # Check that this event wouldn't exceed budgets
             if self.specs.below_maximum(cost, duration):
-                self._add_event(event)
+                self.push_event(event)
                 return True
         elif last_event.location.name == event.location.name:
             # Check that this wouldn't exceed budgets
             if self.specs.below_maximum(cost, duration):
-                self._add_event(event)
+                self.push_event(event)
                 return True
         else:
             # Calculate the transport
@@ -453,8 +717,8 @@ class Tour(object):
                 duration += transport.duration
                 # Check that this wouldn't exceed budgets
                 if self.specs.below_maximum(cost, duration):
-                    self._add_event(transport)
-                    self._add_event(event)
+                    self.push_event(transport)
+                    self.push_event(event)
                     return True
         return False
 
@@ -495,6 +759,26 @@ class Tour(object):
                                            title))
             clock += event.duration
 
+    def as_dict(self):
+        events = []
+        clock = self.specs.start_time
+        for index, event in enumerate(self.events):
+            events.append({
+                'title': event.title,
+                'category': event.category,
+                'meal': self.included_meals.get(index),
+                'start': clock.strftime("%H:%M"),
+                'duration': int(event.duration.total_seconds() // 60),
+                'cost': event.cost,
+            })
+            clock += event.duration
+        return {
+            'cost': self.cost,
+            'duration': int(self.duration.total_seconds() // 60),
+            'included_meals': list(self.included_meals.values()),
+            'events': events,
+        }
+
 
 def generate_event_combinations(event_list):
     combos = []
@@ -504,28 +788,972 @@ def generate_event_combinations(event_list):
     return combos
 
 
-def build_tours(valid_tours, tour, activities, depth=0):
-    depth += 1
+class OutOfTime(Exception):
+    """Raised inside a TourSearch when it passes its deadline."""
+
+
+class SearchStats(object):
+    def __init__(self):
+        self.nodes_explored = 0
+        self.candidates_pruned = 0
+        self.subtrees_pruned = 0
+        self.dominated = 0
+
+    def nodes_pruned(self):
+        return self.candidates_pruned + self.subtrees_pruned + self.dominated
+
+    def merge(self, other):
+        self.nodes_explored += other.nodes_explored
+        self.candidates_pruned += other.candidates_pruned
+        self.subtrees_pruned += other.subtrees_pruned
+        self.dominated += other.dominated
+
+    def __str__(self):
+        return "{} nodes explored, {} pruned ({} candidates, {} subtrees, {} dominated)".format(
+            self.nodes_explored, self.nodes_pruned(), self.candidates_pruned,
+            self.subtrees_pruned, self.dominated)
+
+    def as_dict(self):
+        return dict(vars(self), nodes_pruned=self.nodes_pruned())
+
+
+class SearchTrace(object):
+    """Counters and timings from inside a TourSearch given a trace.
+
+    Counts the activities CompactTour.add turned down by reason and the
+    partial tours made at each depth, and times adding activities,
+    screening candidates and replaying paths into Tours. on_node(tour) and
+    on_reject(tour, activity, reason) are called as they happen, for
+    tracing. Tracing slows the search down, so it is off by default.
+    """
+    reasons = ('not open yet', 'closes too soon', 'food in a row',
+               'duplicate meal', 'coffee out of hours', 'over budget',
+               'no route')
+
+    def __init__(self, on_node=None, on_reject=None):
+        self.rejections = dict.fromkeys(self.reasons, 0)
+        self.nodes_per_depth = []
+        self.seconds = {'add': 0.0, 'screening': 0.0, 'replay': 0.0}
+        self.on_node = on_node
+        self.on_reject = on_reject
+
+    def node(self, tour):
+        depth = len(tour.path)
+        while len(self.nodes_per_depth) < depth:
+            self.nodes_per_depth.append(0)
+        self.nodes_per_depth[depth - 1] += 1
+        if self.on_node is not None:
+            self.on_node(tour)
+
+    def reject(self, tour, activity, reason):
+        self.rejections[reason] += 1
+        if self.on_reject is not None:
+            self.on_reject(tour, activity, reason)
+
+    def as_dict(self, stats=None):
+        out = {
+            'rejections': dict(self.rejections),
+            'nodes_per_depth': list(self.nodes_per_depth),
+            'seconds': dict(self.seconds),
+        }
+        if stats is not None:
+            out['stats'] = stats.as_dict()
+        return out
+
+    def dump(self, path, stats=None):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(stats), f, indent=2)
+
+
+class CompactActivity(object):
+    __slots__ = ('index', 'station', 'opens', 'closes', 'duration', 'cost',
+                 'category', 'is_food', 'is_coffee', 'meal_slots')
+
+    def __init__(self, index, activity):
+        self.index = index
+        self.station = activity.location.index
+        self.opens = activity.opens
+        self.closes = activity.closes
+        self.duration = activity.minutes
+        self.cost = activity.cost
+        self.category = activity.category
+        self.meal_slots = activity.meal_slots
+        self.is_food = self.meal_slots is not None
+        self.is_coffee = activity.category == 'coffee'
+
+
+class CompactTour(object):
+    """Search-time tour, following the same rules as Tour.add_activity.
+
+    Times are integer minutes, costs integer yen, the activities are indexes
+    into the catalogue and the meals had are a bitmask. See replay_tour for
+    turning one back into a Tour.
+    """
+    __slots__ = ('specs', 'activities', 'matrix', 'path', 'visited', 'cost',
+                 'minutes', 'meals', 'last', 'log')
+
+    def __init__(self, specs, activities, matrix):
+        self.specs = specs
+        self.activities = activities
+        self.matrix = matrix
+        self.path = array('H')
+        self.visited = 0
+        self.cost = 0
+        self.minutes = 0
+        self.meals = 0
+        self.last = None
+        # The cost, minutes and meals before each add, for pop
+        self.log = array('q')
+
+    def end(self):
+        return self.specs.start_minutes + self.minutes
+
+    def add(self, activity):
+        specs = self.specs
+        last = self.last
+        end = specs.start_minutes + self.minutes
+        # Check that it's open now, and for as long as we need
+        if end < activity.opens or end + activity.duration > activity.closes:
+            return False
+        if activity.is_food:
+            # Don't do two food activities in a row
+            if last is not None and last.is_food:
+                return False
+            # Don't have the same meal twice, or coffee out of hours
+            meal = activity.meal_slots[end] if end < day_minutes else 0
+            if meal & self.meals or (meal == 0 and activity.is_coffee):
+                return False
+
+        cost = self.cost + activity.cost
+        minutes = self.minutes + activity.duration
+        if last is None:
+            # The meet & greet isn't counted against the budgets
+            travel = meet_minutes
+        elif last.station == activity.station:
+            travel = 0
+        else:
+            matrix = self.matrix
+            cell = last.station * matrix.size + activity.station
+            travel = matrix.minutes[cell]
+            if travel == matrix.unreachable:
+                raise LookupError("No route to {}".format(activity.index))
+            cost += matrix.costs[cell]
+            minutes += travel
+        if not specs.below_maximum_minutes(cost, minutes):
+            return False
+        if last is None:
+            minutes += travel
+
+        self.log.append(self.cost)
+        self.log.append(self.minutes)
+        self.log.append(self.meals)
+        if activity.is_food and end + travel < day_minutes:
+            self.meals |= activity.meal_slots[end + travel]
+        self.cost = cost
+        self.minutes = minutes
+        self.path.append(activity.index)
+        self.visited |= 1 << activity.index
+        self.last = activity
+        return True
+
+    def pop(self):
+        index = self.path.pop()
+        self.visited &= ~(1 << index)
+        self.meals = self.log.pop()
+        self.minutes = self.log.pop()
+        self.cost = self.log.pop()
+        self.last = self.activities[self.path[-1]] if self.path else None
+
+    def within_spec(self):
+        return self.specs.within_spec_minutes(self.cost, self.minutes)
+
+
+class TracedCompactTour(CompactTour):
+    """CompactTour reporting to a SearchTrace."""
+    __slots__ = ('trace',)
+
+    def __init__(self, specs, activities, matrix, trace):
+        super(TracedCompactTour, self).__init__(specs, activities, matrix)
+        self.trace = trace
+
+    def add(self, activity):
+        started = perf_counter()
+        try:
+            added = CompactTour.add(self, activity)
+        except LookupError:
+            self.trace.reject(self, activity, 'no route')
+            raise
+        finally:
+            self.trace.seconds['add'] += perf_counter() - started
+        if added:
+            self.trace.node(self)
+        else:
+            self.trace.reject(self, activity, self.rejection(activity))
+        return added
+
+    def rejection(self, activity):
+        # Which of the checks in CompactTour.add turned the activity down
+        end = self.end()
+        if end < activity.opens:
+            return 'not open yet'
+        if end + activity.duration > activity.closes:
+            return 'closes too soon'
+        if activity.is_food:
+            if self.last is not None and self.last.is_food:
+                return 'food in a row'
+            meal = activity.meal_slots[end] if end < day_minutes else 0
+            if meal & self.meals:
+                return 'duplicate meal'
+            if meal == 0 and activity.is_coffee:
+                return 'coffee out of hours'
+        return 'over budget'
+
+
+class SearchBounds(object):
+    """Admissible per-activity bounds used to prune the tour search.
+
+    An activity is dropped from a subtree once CompactTour.add could never
+    accept it there, and a subtree is cut when even adding every remaining
+    activity could not reach the minimum duration or cost of the specs.
+    """
+
+    def __init__(self, specs, activities, matrix):
+        self.specs = specs
+        self.activities = activities
+        self.latest_start = array('l')
+        self.min_minutes = array('l')
+        self.min_cost = array('l')
+        self.max_minutes = array('l')
+        self.max_cost = array('l')
+        self.reachable = []
+        for activity in activities:
+            minutes = []
+            costs = []
+            for other in activities:
+                if other is activity:
+                    continue
+                route = matrix.route(other.station, activity.station)
+                if route is not None:
+                    minutes.append(route[0])
+                    costs.append(route[1])
+            if len(minutes) == 0:
+                minutes.append(0)
+                costs.append(0)
+            # Cheapest and dearest way to arrive at and do this activity
+            self.min_minutes.append(min(minutes) + activity.duration)
+            self.min_cost.append(min(costs) + activity.cost)
+            self.max_minutes.append(max(minutes) + activity.duration)
+            self.max_cost.append(max(costs) + activity.cost)
+            latest_start = activity.closes - activity.duration
+            self.latest_start.append(latest_start)
+            # Events are back to back, so the tour must already have run
+            # until the activity opens before it can be added
+            reachable = latest_start >= activity.opens
+            if specs.max_minutes is not None:
+                reachable = reachable and (activity.opens - specs.start_minutes
+                                           + self.min_minutes[-1]
+                                           <= specs.max_minutes)
+            self.reachable.append(reachable)
+
+        # The activities that can directly follow each activity, as a
+        # bitmask of their indexes. Events are back to back, so the next
+        # activity has to be open when this one ends, and still have time
+        # to be done before it closes.
+        self.successors = []
+        for activity in activities:
+            index = activity.index
+            earliest_end = max(activity.opens, specs.start_minutes) \
+                + activity.duration
+            # Travel to an activity is added after its hours are checked
+            latest_end = activity.closes + max(
+                self.max_minutes[index] - activity.duration, meet_minutes)
+            successors = 0
+            for other in activities:
+                if other is activity \
+                        or (activity.is_food and other.is_food) \
+                        or other.opens > latest_end \
+                        or earliest_end + other.duration > other.closes:
+                    continue
+                if other.is_coffee:
+                    first = max(earliest_end, other.opens)
+                    last = min(latest_end, other.closes - other.duration,
+                               day_minutes - 1)
+                    if not any(other.meal_slots[first:last + 1]):
+                        continue
+                successors |= 1 << other.index
+            self.successors.append(successors)
+
+    def live_candidates(self, tour, stats):
+        """Return the activities that can still be added somewhere below
+        this tour, or None if no tour below it can meet the specs."""
+        specs = self.specs
+        end = tour.end()
+        coffee_over = end >= coffee_end or tour.meals & coffee_meal
+        max_cost = specs.max_cost
+        max_minutes = specs.max_minutes
+        visited = tour.visited
+        live = []
+        potential_minutes = tour.minutes
+        potential_cost = tour.cost
+        for activity in self.activities:
+            index = activity.index
+            if visited >> index & 1:
+                continue
+            if not self.reachable[index] \
+                    or end > self.latest_start[index] \
+                    or (max_minutes is not None and tour.minutes + self.min_minutes[index] > max_minutes) \
+                    or (max_cost is not None and tour.cost + self.min_cost[index] > max_cost) \
+                    or (coffee_over and activity.is_coffee):
+                stats.candidates_pruned += 1
+                continue
+            live.append(activity)
+            potential_minutes += self.max_minutes[index]
+            potential_cost += self.max_cost[index]
+        if (specs.min_minutes is not None and potential_minutes < specs.min_minutes) \
+                or (specs.min_cost is not None and potential_cost < specs.min_cost):
+            stats.subtrees_pruned += 1
+            return None
+        return live
+
+    def screen(self, tour, stats):
+        """Return the live candidates, as live_candidates, and those of
+        them that can follow the last activity of the tour."""
+        live = self.live_candidates(tour, stats)
+        if live is None or tour.last is None:
+            return live, live
+        successors = self.successors[tour.last.index]
+        return live, [activity for activity in live
+                      if successors >> activity.index & 1]
+
+
+class VectorSearchBounds(SearchBounds):
+    """SearchBounds screening all of the activities at once with NumPy.
+
+    screen also makes the checks of CompactTour.add that don't change the
+    tour, so the candidates it returns are those add would accept, or fail
+    to find a route to. Rows of the tables indexed by the last station have
+    an extra row at the end for tours with no activities yet.
+    """
+
+    def __init__(self, specs, activities, matrix):
+        super(VectorSearchBounds, self).__init__(specs, activities, matrix)
+
+        def vector(values, dtype=numpy.int64):
+            return numpy.array(list(values), dtype=dtype)
+
+        self.size = len(activities)
+        self.opens = vector(activity.opens for activity in activities)
+        self.is_coffee = vector((activity.is_coffee for activity in activities),
+                                bool)
+        self.v_reachable = vector(self.reachable, bool)
+        self.v_latest_start = vector(self.latest_start)
+        self.v_min_minutes = vector(self.min_minutes)
+        self.v_min_cost = vector(self.min_cost)
+        self.v_max_minutes = vector(self.max_minutes)
+        self.v_max_cost = vector(self.max_cost)
+        self.v_successors = numpy.array(
+            [[successors >> activity.index & 1 for activity in activities]
+             for successors in self.successors], dtype=bool)
+
+        # The meal had by starting each activity at each minute of the day,
+        # and whether it's coffee out of hours, with a row for after midnight
+        self.meals = numpy.zeros((day_minutes + 1, self.size), numpy.uint8)
+        for activity in activities:
+            if activity.meal_slots is not None:
+                self.meals[:day_minutes, activity.index] = numpy.frombuffer(
+                    bytes(activity.meal_slots), numpy.uint8)
+        self.no_coffee = (self.meals == 0) & self.is_coffee
+
+        # The minutes and cost of going from each station to each activity
+        # and doing it. Unreachable ones are left for add to raise on.
+        stations = vector(activity.station for activity in activities)
+        shape = (matrix.size, matrix.size)
+        minutes = numpy.frombuffer(matrix.minutes, numpy.uint16).reshape(shape)
+        costs = numpy.frombuffer(matrix.costs, numpy.uint16).reshape(shape)
+        duration = vector(activity.duration for activity in activities)
+        cost = vector(activity.cost for activity in activities)
+        unreachable = minutes[:, stations] == matrix.unreachable
+        self.minutes_to = numpy.vstack([minutes[:, stations] + duration,
+                                        duration])
+        self.cost_to = numpy.vstack([costs[:, stations] + cost, cost])
+        self.minutes_to[:-1][unreachable] = -1
+        self.cost_to[:-1][unreachable] = -1
+
+    def screen(self, tour, stats):
+        specs = self.specs
+        end = tour.end()
+        live = self.v_reachable & (end <= self.v_latest_start)
+        live[numpy.frombuffer(tour.path, numpy.uint16)] = False
+        if specs.max_minutes is not None:
+            live &= self.v_min_minutes <= specs.max_minutes - tour.minutes
+        if specs.max_cost is not None:
+            live &= self.v_min_cost <= specs.max_cost - tour.cost
+        if end >= coffee_end or tour.meals & coffee_meal:
+            live &= ~self.is_coffee
+        count = int(numpy.count_nonzero(live))
+        stats.candidates_pruned += self.size - len(tour.path) - count
+        if (specs.min_minutes is not None and tour.minutes +
+                int(self.v_max_minutes[live].sum()) < specs.min_minutes) \
+                or (specs.min_cost is not None and tour.cost +
+                    int(self.v_max_cost[live].sum()) < specs.min_cost):
+            stats.subtrees_pruned += 1
+            return None, None
+
+        # The checks of CompactTour.add
+        row = -1 if tour.last is None else tour.last.station
+        minute = min(end, day_minutes)
+        ok = live & (self.opens <= end) & ~self.no_coffee[minute]
+        if tour.last is not None:
+            ok &= self.v_successors[tour.last.index]
+        if tour.meals:
+            ok &= (self.meals[minute] & tour.meals) == 0
+        if specs.max_minutes is not None:
+            ok &= self.minutes_to[row] <= specs.max_minutes - tour.minutes
+        if specs.max_cost is not None:
+            ok &= self.cost_to[row] <= specs.max_cost - tour.cost
+
+        activities = self.activities
+        return ([activities[index] for index in live.nonzero()[0].tolist()],
+                [activities[index] for index in ok.nonzero()[0].tolist()])
+
+
+class TracedSearchBounds(SearchBounds):
+    """SearchBounds timing its screening for a SearchTrace."""
+
+    def __init__(self, specs, activities, matrix, trace):
+        super(TracedSearchBounds, self).__init__(specs, activities, matrix)
+        self.trace = trace
+
+    def live_candidates(self, tour, stats):
+        started = perf_counter()
+        try:
+            return SearchBounds.live_candidates(self, tour, stats)
+        finally:
+            self.trace.seconds['screening'] += perf_counter() - started
+
+
+class PartialTourMemo(object):
+    """Remembers the partial tours seen so far, so that the search can skip
+    a partial tour that is dominated by an equivalent one.
+
+    Partial tours are equivalent when they have visited the same activities,
+    are at the same station, finish at the same minute, have included the
+    same meals and agree on whether they just ate. Whatever can follow one
+    of them can follow the others, so of those only the cheapest needs to
+    be expanded: the other orderings of the same activities that cost no
+    less are dropped. With a minimum cost, a cheaper tour could fall short
+    of it, so only orderings that cost the same are dropped.
+    """
+
+    def __init__(self, specs):
+        self.exact_cost = specs.min_cost is not None
+        self.cheapest = {}
+
+    def key(self, tour):
+        key = (tour.visited,
+               tour.last.station,
+               tour.minutes,
+               tour.meals,
+               tour.last.is_food)
+        if self.exact_cost:
+            key += (tour.cost,)
+        return key
+
+    def dominated(self, tour):
+        """Record the tour, returning True if an equivalent tour already
+        recorded is at least as cheap."""
+        key = self.key(tour)
+        cost = self.cheapest.get(key)
+        if cost is not None and cost <= tour.cost:
+            return True
+        self.cheapest[key] = tour.cost
+        return False
+
+
+class TourScore(object):
+    """Scores a CompactTour, higher is better.
+
+    Scores are tuples compared lexicographically. upper_bound must never be
+    lower than the score of any tour made by adding some of the candidate
+    activities to the tour, so that the search can use it for pruning.
+    """
+
+    def __call__(self, tour):
+        raise NotImplementedError
+
+    def upper_bound(self, tour, candidates):
+        raise NotImplementedError
+
+
+class ActivityCountScore(TourScore):
+    # Most activities, then cheapest
+    def __call__(self, tour):
+        return (len(tour.path), -tour.cost)
+
+    def upper_bound(self, tour, candidates):
+        return (len(tour.path) + len(candidates), -tour.cost)
+
+
+class CostEfficiencyScore(TourScore):
+    # Activities per thousand yen spent
+    def __call__(self, tour):
+        return (len(tour.path) / (1 + tour.cost / 1000),)
+
+    def upper_bound(self, tour, candidates):
+        count = len(tour.path) + len(candidates)
+        return (count / (1 + tour.cost / 1000),)
+
+
+class CategoryDiversityScore(TourScore):
+    # Most distinct categories, then most activities, then cheapest
+    def __call__(self, tour):
+        categories = set(tour.activities[index].category for index in tour.path)
+        return (len(categories), len(tour.path), -tour.cost)
+
+    def upper_bound(self, tour, candidates):
+        categories = set(tour.activities[index].category for index in tour.path)
+        categories.update(activity.category for activity in candidates)
+        return (len(categories), len(tour.path) + len(candidates), -tour.cost)
+
+
+class MealCoverageScore(TourScore):
+    # Most distinct meals, then most activities, then cheapest
+    def __call__(self, tour):
+        return (bin(tour.meals).count('1'), len(tour.path), -tour.cost)
+
+    def upper_bound(self, tour, candidates):
+        meals = bin(tour.meals).count('1')
+        meals += len([activity for activity in candidates if activity.is_food])
+        return (min(meals, len(meal_times)),
+                len(tour.path) + len(candidates),
+                -tour.cost)
+
+
+tour_scores = {
+    'activities': ActivityCountScore(),
+    'cost-efficiency': CostEfficiencyScore(),
+    'diversity': CategoryDiversityScore(),
+    'meals': MealCoverageScore(),
+}
+
+
+class BestTours(object):
+    """Keeps the paths of the k best tours found so far in a min-heap."""
+
+    def __init__(self, k, score):
+        self.k = k
+        self.score = score
+        self.heap = []
+        self.found = 0
+
+    def offer(self, tour, path=None):
+        score = self.score(tour)
+        if len(self.heap) < self.k or (score, -self.found) > self.heap[0][:2]:
+            self.push(score, path or array('H', tour.path))
+        else:
+            self.found += 1
+
+    def push(self, score, path):
+        # Among equal scores the tour found first is kept
+        entry = (score, -self.found, path)
+        self.found += 1
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+
+    def can_improve(self, tour, candidates):
+        if len(self.heap) < self.k:
+            return True
+        return self.score.upper_bound(tour, candidates) > self.heap[0][0]
+
+    def tours(self):
+        return [entry[2] for entry in sorted(self.heap, reverse=True)]
+
+    def entries_in_found_order(self):
+        return [(entry[0], entry[2])
+                for entry in sorted(self.heap, key=lambda x: -x[1])]
+
+
+class TourSearch(object):
+    """Depth first search for tours, extending a single CompactTour in place.
+
+    Tours are found as paths, arrays of the indexes of the activities added
+    to make them, and only turned into Tour objects by run unless compact
+    is set. With split_depth set, partial tours of that many activities are
+    not expanded but listed in frontier as ('subtree', None, path) items,
+    in order with the ('tour', score, path) items for the valid tours found
+    above them. With a SearchTrace as trace the search reports to it.
+    """
+
+    def __init__(self, specs, activities, dedup=False, best=None,
+                 compact=False, split_depth=None, trace=None):
+        self.specs = specs
+        self.activities = activities
+        matrix = get_travel_matrix()
+        self.compact_activities = [CompactActivity(index, activity)
+                                   for index, activity in enumerate(activities)]
+        self.trace = trace
+        if trace is None:
+            self.tour = CompactTour(specs, self.compact_activities, matrix)
+            if numpy is not None and len(activities) >= vector_min_activities:
+                self.bounds = VectorSearchBounds(specs, self.compact_activities,
+                                                 matrix)
+            else:
+                self.bounds = SearchBounds(specs, self.compact_activities,
+                                           matrix)
+        else:
+            self.tour = TracedCompactTour(specs, self.compact_activities,
+                                          matrix, trace)
+            self.bounds = TracedSearchBounds(specs, self.compact_activities,
+                                             matrix, trace)
+        self.compact = compact
+        self.split_depth = split_depth
+        self.frontier = [] if split_depth is not None else None
+        self.memo = None
+        if dedup:
+            self.memo = PartialTourMemo(specs)
+        self.best = best
+        self.stats = SearchStats()
+        self.valid_tours = []
+        self.complete = True
+        self.deadline = None
+
+    def run(self, time_limit=None):
+        """Search for tours, giving up time_limit seconds in. complete is
+        left False if the search was cut short."""
+        paths = self.iter_paths()
+        if time_limit is not None:
+            paths = self.until(paths, monotonic() + time_limit)
+        self.collect(paths)
+        return self.results()
+
+    def until(self, paths, deadline):
+        # The deadline is checked each time a tour is found, and every
+        # deadline_check_nodes nodes in case none are
+        self.complete = False
+        self.deadline = deadline
+        try:
+            for path in paths:
+                yield path
+                if monotonic() >= deadline:
+                    return
+            self.complete = True
+        except OutOfTime:
+            pass
+        finally:
+            self.deadline = None
+
+    def check_deadline(self):
+        if self.stats.nodes_explored % deadline_check_nodes == 0 \
+                and monotonic() >= self.deadline:
+            raise OutOfTime()
+
+    def run_subtree(self, path):
+        # Search below the partial tour made of path, without reporting or
+        # counting the partial tour itself
+        for index in path:
+            self.tour.add(self.compact_activities[index])
+        self.collect(self.build_tours(len(path) - 1))
+        return self.results()
+
+    def collect(self, paths):
+        for path in paths:
+            if self.best is None and self.frontier is None:
+                self.valid_tours.append(path)
+
+    def iter_paths(self):
+        """Yield the path of each valid tour as soon as it is found.
+
+        The search can't be resumed if the generator is closed early.
+        """
+        tour = self.tour
+        for activity in self.compact_activities:
+            if tour.add(activity):
+                self.stats.nodes_explored += 1
+                yield from self.descend()
+                tour.pop()
+
+    def iter_tours(self, limit=None):
+        """Yield each valid Tour as soon as it is found, stopping after
+        limit tours."""
+        paths = self.iter_paths()
+        if limit is not None:
+            paths = itertools.islice(paths, limit)
+        for path in paths:
+            yield self.replay(path)
+
+    def results(self):
+        paths = self.valid_tours
+        if self.best is not None:
+            paths = self.best.tours()
+        if self.compact:
+            return paths
+        return [self.replay(path) for path in paths]
+
+    def replay(self, path):
+        if self.trace is None:
+            return replay_tour(self.specs, self.activities, path)
+        started = perf_counter()
+        try:
+            return replay_tour(self.specs, self.activities, path)
+        finally:
+            self.trace.seconds['replay'] += perf_counter() - started
+
+    def add_valid_tour(self):
+        tour = self.tour
+        path = array('H', tour.path)
+        if self.frontier is not None:
+            score = self.best.score(tour) if self.best is not None else None
+            self.frontier.append(('tour', score, path))
+        elif self.best is not None:
+            self.best.offer(tour, path)
+        return path
+
+    def descend(self, depth=0):
+        if self.frontier is not None \
+                and len(self.tour.path) >= self.split_depth:
+            self.frontier.append(('subtree', None, array('H', self.tour.path)))
+        else:
+            yield from self.build_tours(depth)
+
+    def build_tours(self, depth=0):
+        depth += 1
+        tour = self.tour
+        specs = self.specs
+
+        live, candidates = self.bounds.screen(tour, self.stats)
+        if live is None:
+            return
+        if self.best is not None and not self.best.can_improve(tour, live):
+            self.stats.subtrees_pruned += 1
+            return
+
+        cost_limit = None
+        if specs.max_cost is not None:
+            cost_limit = specs.max_cost - tour.cost
+        duration_limit = None
+        if specs.max_minutes is not None:
+            duration_limit = specs.max_minutes - tour.minutes
+
+        for next_activity in candidates:
+            if (duration_limit is not None
+                    and next_activity.duration >= duration_limit) \
+                    or (cost_limit is not None
+                        and next_activity.cost >= cost_limit):
+                continue
+            if tour.add(next_activity):
+                if self.memo is not None and self.memo.dominated(tour):
+                    self.stats.dominated += 1
+                else:
+                    self.stats.nodes_explored += 1
+                    if self.deadline is not None:
+                        self.check_deadline()
+                    if tour.within_spec():
+                        yield self.add_valid_tour()
+                    yield from self.descend(depth)
+                tour.pop()
+
+
+def replay_tour(specs, activities, path):
+    # Make the Tour, with all of its events, for a path found by TourSearch
+    tour = Tour(specs)
+    for index in path:
+        activity = activities[index]
+        if len(tour.events) == 0:
+            tour.push_event(Meet(activity.location))
+        else:
+            transport = get_transport(tour.events[-1], activity)
+            if transport is not None:
+                tour.push_event(transport)
+        tour.push_event(activity)
+    return tour
+
+
+worker_search = None
+
+
+def init_search_worker(specs, activities, options, matrix):
+    global worker_search, travel_matrix
+    # The stations of the activities are indexes into this matrix
+    travel_matrix = matrix
+    worker_search = (specs, activities, options)
+
+
+def search_subtree(path):
+    specs, activities, options = worker_search
+    best = None
+    if options['best'] is not None:
+        best = BestTours(*options['best'])
+    search = TourSearch(specs, activities, options['dedup'], best,
+                        compact=True)
+    search.run_subtree(path)
+    if best is not None:
+        return best.entries_in_found_order(), search.stats
+    return [(None, path) for path in search.valid_tours], search.stats
+
+
+class ParallelTourSearch(object):
+    """Runs the subtrees below the first split_depth activities of a
+    TourSearch in a process pool.
+
+    Workers send back tours as activity index paths, which are merged here
+    in the same order as a serial search would find them. Each worker keeps
+    its own dedup memo, so with dedup set a parallel search can keep more
+    equivalent tours than a serial one.
+    """
+
+    def __init__(self, specs, activities, workers, split_depth=1,
+                 dedup=False, best=None, compact=False):
+        self.specs = specs
+        self.activities = activities
+        self.workers = workers
+        self.split_depth = split_depth
+        self.dedup = dedup
+        self.best = best
+        self.compact = compact
+        self.stats = SearchStats()
+        self.valid_tours = []
+
+    def run(self):
+        search = TourSearch(self.specs, self.activities, self.dedup,
+                            self.best, compact=True,
+                            split_depth=self.split_depth)
+        search.run()
+        self.stats = search.stats
+        subtrees = [path for kind, score, path in search.frontier
+                    if kind == 'subtree']
+        options = {
+            'dedup': self.dedup,
+            'best': None,
+        }
+        if self.best is not None:
+            options['best'] = (self.best.k, self.best.score)
+        chunksize = max(1, len(subtrees) // (self.workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(
+                self.workers, initializer=init_search_worker,
+                initargs=(self.specs, self.activities, options,
+                          get_travel_matrix())) as executor:
+            results = executor.map(search_subtree, subtrees,
+                                   chunksize=chunksize)
+            for kind, score, path in search.frontier:
+                if kind == 'tour':
+                    self.add_valid_tour(score, path)
+                    continue
+                tours, stats = next(results)
+                self.stats.merge(stats)
+                for score, path in tours:
+                    self.add_valid_tour(score, path)
+        paths = self.valid_tours
+        if self.best is not None:
+            paths = self.best.tours()
+        if self.compact:
+            return paths
+        return [replay_tour(self.specs, self.activities, path)
+                for path in paths]
+
+    def add_valid_tour(self, score, path):
+        if self.best is not None:
+            self.best.push(score, path)
+        else:
+            self.valid_tours.append(path)
+
+
+def search_tours(specs, activities, dedup=False):
+    return TourSearch(specs, activities, dedup).run()
+
+
+def search_best_tours(specs, activities, k, score=tour_scores['activities'],
+                      dedup=False, time_limit=None):
+    best = BestTours(k, score)
+    search = TourSearch(specs, activities, dedup, best)
+    return search.run(time_limit)
 
-    cost_limit = tour.remaining_money()
-    duration_limit = tour.remaining_time()
 
-    activities = [x for x in activities if x.duration <
-                  duration_limit and x.cost < cost_limit]
+def iter_tours(specs, activities, limit=None, dedup=False):
+    return TourSearch(specs, activities, dedup).iter_tours(limit)
 
-    for index in range(len(activities)):
-        activities_copy = copy.copy(activities)
-        next_activity = activities_copy[index]
-        activities_copy.remove(next_activity)
-        tour_copy = copy.deepcopy(tour)
-        if tour_copy.add_activity(next_activity):
-            if tour_copy.within_spec():
-                valid_tours.append(tour_copy)
-            build_tours(valid_tours, tour_copy, activities_copy, depth)
+
+async def aiter_tours(specs, activities, limit=None, dedup=False,
+                      queue_size=100):
+    """Asynchronous iter_tours, the search runs in a thread and blocks
+    once queue_size tours are waiting to be consumed."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for tour in iter_tours(specs, activities, limit, dedup):
+                if stop.is_set():
+                    break
+                asyncio.run_coroutine_threadsafe(queue.put(tour), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(queue.put(done), loop).result()
+
+    producer = loop.run_in_executor(None, produce)
+    tour = None
+    try:
+        while tour is not done:
+            tour = await queue.get()
+            if tour is not done:
+                yield tour
+    finally:
+        stop.set()
+        while tour is not done:
+            tour = await queue.get()
+        await producer
 
 
 if __name__ == "__main__":
-    activities = load_activities(path_activities)
+    parser = argparse.ArgumentParser(description="Build tours from the activities")
+    parser.add_argument('--dedup', action='store_true',
+                        help="keep one tour per set of equivalent orderings")
+    parser.add_argument('--best', type=int, metavar='K',
+                        help="only keep the K best tours")
+    parser.add_argument('--score', choices=sorted(tour_scores),
+                        default='activities',
+                        help="how --best ranks tours")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="search in N processes")
+    parser.add_argument('--split-depth', type=int, default=1,
+                        help="number of activities to add before handing "
+                             "the rest of a tour to a worker")
+    parser.add_argument('--limit', type=int, metavar='N',
+                        help="stop after N tours")
+    parser.add_argument('--format', choices=['text', 'json'], default='text',
+                        help="print itinearies or one JSON object per line")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="write search counters and timings to FILE "
+                             "as JSON")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="profile the search with cProfile and write "
+                             "the stats to FILE")
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help="read the activities and travel matrix from a "
+                             "snapshot made with --write-snapshot")
+    parser.add_argument('--write-snapshot', metavar='FILE',
+                        help="compile the activities and travel matrix into "
+                             "a snapshot FILE and exit")
+    parser.add_argument('--skip-snapshot-check', action='store_true',
+                        help="use the --snapshot even if the activities or "
+                             "transit database changed since it was made")
+    args = parser.parse_args()
+    if args.trace and args.workers > 1:
+        parser.error("--trace only works with a single worker")
+
+    if args.snapshot:
+        try:
+            activities = load_snapshot(args.snapshot,
+                                       not args.skip_snapshot_check)
+        except ValueError as error:
+            parser.error(str(error))
+    else:
+        activities = load_activities(path_activities)
+    if args.write_snapshot:
+        write_snapshot(args.write_snapshot, activities)
+        sys.exit()
 
     # Setup tour specifications
     specs = Specifications(num_people=1, start_time=datetime.time(8, 0))
@@ -533,16 +1761,35 @@ if __name__ == "__main__":
     specs.set_min_end_time(datetime.time(16, 0))
     specs.set_max_end_time(datetime.time(17, 0))
 
-    tours = []
-
-    for index in range(len(activities)):
-        activity_list = copy.copy(activities)
-        tour = Tour(specs)
-        if tour.add_activity(activity_list.pop(index)):
-            build_tours(tours, tour, activity_list)
+    best = None
+    if args.best is not None:
+        best = BestTours(args.best, tour_scores[args.score])
+    if args.workers > 1:
+        search = ParallelTourSearch(specs, activities, args.workers,
+                                    args.split_depth, args.dedup, best)
+    else:
+        trace = SearchTrace() if args.trace else None
+        search = TourSearch(specs, activities, args.dedup, best,
+                            trace=trace)
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if best is None and args.workers == 1:
+        tours = search.iter_tours(args.limit)
+    else:
+        tours = itertools.islice(search.run(), args.limit)
 
     for tour_number, tour in enumerate(tours):
+        if args.format == 'json':
+            print(json.dumps(tour.as_dict()), flush=True)
+            continue
         print("Tour Idea {}:".format(tour_number))
         tour.print_itineary()
-        print("")
-    ("")
+        print("", flush=True)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if args.trace:
+        search.trace.dump(args.trace, search.stats)
+    print("Search: {}".format(search.stats), file=sys.stderr)
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import argparse
 import copy
 import csv
 import datetime
@@ -11,10 +12,11 @@ import time
 
 path_activities = "activities.csv"
 path_fixtures = "django_db_fixtures.json"
+path_fixtures_lines = "django_db_fixtures.jsonl"
 path_transit_database = "tokyo-transit.db"
 
-conn = sqlite3.connect(path_transit_database)
-c = conn.cursor()
+conn = None
+c = None
 
 ref_date_str = "1970-01-01"
 station_id_pks = {}
@@ -22,9 +24,41 @@ station_name_pks = {}
 category_pks = {}
 
 
-def write_json(path, data):
+def connect(path):
+    global conn, c
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+
+
+def write_fixtures(path, fixtures, fmt='json', indent=2):
+    """Write fixtures to path as they are generated, either as a JSON
+    list, laid out as json.dumps would with indent, or as JSON Lines."""
     with open(path, 'w') as f:
-        f.write(json.dumps(data, indent=2, ensure_ascii=False))
+        if fmt == 'jsonl':
+            for fixture in fixtures:
+                f.write(json.dumps(fixture, ensure_ascii=False))
+                f.write("\n")
+            return
+        separators = (',', ':') if indent is None else None
+        prefix = " " * (indent or 0)
+        f.write("[")
+        count = 0
+        for fixture in fixtures:
+            text = json.dumps(fixture, indent=indent, separators=separators,
+                              ensure_ascii=False)
+            f.write(",\n" if count else "\n")
+            f.write(prefix + text.replace("\n", "\n" + prefix))
+            count += 1
+        f.write("\n]" if count else "]")
+
+
+def iter_rows(query, batch_size):
+    c.execute(query)
+    while True:
+        rows = c.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
 
 
 def load_csv(csv_path):
@@ -65,7 +99,7 @@ def load_activities(path_activities):
     return parse_csv(path_activities, keys)
 
 
-def gen_station_fixtures(basename):
+def gen_station_fixtures(basename, batch_size=1000):
     global station_id_pks, station_name_pks
 
     query = '''
@@ -74,10 +108,7 @@ def gen_station_fixtures(basename):
             station_id
         FROM stations
     '''
-    c.execute(query)
-    results = c.fetchall()
-    out = []
-    for index, result in enumerate(results):
+    for index, result in enumerate(iter_rows(query, batch_size)):
         pk = index + 1
         station_name = result[0]
         station_id = int(result[1])
@@ -85,41 +116,51 @@ def gen_station_fixtures(basename):
             print("A station with this station_id has already been added, skipping")
             print(result)
             continue
-        out.append({
+        yield {
             'model': "{}.station".format(basename),
             'pk': pk,
             'fields': {
                 'station_id': station_id
             }
-        })
-        out.append({
+        }
+        yield {
             'model': "{}.location".format(basename),
             'pk': pk,
             'fields': {
                 'name': "{}".format(station_name)
             }
-        })
+        }
         station_id_pks[station_id] = pk
         station_name_pks[station_name] = pk
-    return out
 
 
-def gen_transport_fixtures(basename):
+def gen_transport_fixtures(basename, batch_size=1000):
     global station_id_pks
     query = '''
         SELECT from_id,
              to_id,
              mins,
              cost,
-             transfers
-        FROM routes;
+             transfers,
+             0
+        FROM routes
     '''
-    c.execute(query)
-    results = c.fetchall()
-    out = []
-    for index, result in enumerate(results):
-        pk = (index * 2) # RESUME Make sure you're not adding duplicate pks!
-        # pk = index + 1
+    # Routes that differ in one direction, if the database has any
+    c.execute("SELECT name FROM sqlite_master "
+              "WHERE type = 'table' AND name = 'one_way_routes'")
+    if c.fetchone() is not None:
+        query += '''
+        UNION ALL
+        SELECT from_id,
+             to_id,
+             mins,
+             cost,
+             transfers,
+             1
+        FROM one_way_routes
+    '''
+    for index, result in enumerate(iter_rows(query, batch_size)):
+        pk = index + 1
         if int(result[0]) not in station_id_pks or int(result[1]) not in station_id_pks:
             print("Error: Can't find the station for this trip!")
             print(result)
@@ -127,33 +168,27 @@ def gen_transport_fixtures(basename):
 
         from_station_pk = station_id_pks[int(result[0])]
         to_station_pk = station_id_pks[int(result[1])]
+        one_way = bool(result[5])
+        # A ride both ways is stored once, from the station with the lower pk
+        if not one_way and from_station_pk > to_station_pk:
+            from_station_pk, to_station_pk = to_station_pk, from_station_pk
         duration_str = str(datetime.timedelta(minutes=int(result[2])))
         cost = int(result[3])
         transfers = int(result[4])
-        # Add both directions in as the same trip (for now)
-        out.append({
+        fields = {
+            'from_station': from_station_pk,
+            'to_station': to_station_pk,
+            'duration': duration_str,
+            'cost': cost,
+            'transfers': transfers
+        }
+        if one_way:
+            fields['one_way'] = True
+        yield {
             'model': "{}.trainride".format(basename),
             'pk': pk,
-            'fields': {
-                'from_station': from_station_pk,
-                'to_station': to_station_pk,
-                'duration': duration_str,
-                'cost': cost,
-                'transfers': transfers
-            }
-        })
-        out.append({
-            'model': "{}.trainride".format(basename),
-            'pk': pk + 1,
-            'fields': {
-                'from_station': to_station_pk,
-                'to_station': from_station_pk,
-                'duration': duration_str,
-                'cost': cost,
-                'transfers': transfers
-            }
-        })
-    return out
+            'fields': fields
+        }
 
 
 def gen_category_fixtures(basename):
@@ -195,7 +230,9 @@ def gen_activities_fixtures(basename):
     for index, activity in enumerate(activities):
         pk = index + 1
         title = activity['name']
-        duration = str(datetime.timedelta(hours=float(activity['duration'])))
+        # In whole minutes, as builder.py searches them
+        duration = str(datetime.timedelta(
+            minutes=round(float(activity['duration']) * 60)))
         cost = int(activity['cost'])
 
         available_from = "{} 00:00:00".format(ref_date_str)
@@ -227,20 +264,40 @@ def gen_activities_fixtures(basename):
     return out
 
 
-def main():
-    app_name = 'tourbuilder'
-    station_fixtures = gen_station_fixtures(app_name)
-    transport_fixtures = gen_transport_fixtures(app_name)
-    category_fixtures = gen_category_fixtures(app_name)
-    activities_fixtures = gen_activities_fixtures(app_name)
+def gen_fixtures(app_name, batch_size=1000):
+    # In order, the activities need the stations and categories before them
+    station_id_pks.clear()
+    station_name_pks.clear()
+    category_pks.clear()
+    yield from gen_station_fixtures(app_name, batch_size)
+    yield from gen_transport_fixtures(app_name, batch_size)
+    yield from gen_category_fixtures(app_name)
+    yield from gen_activities_fixtures(app_name)
 
-    out = []
-    out += station_fixtures
-    out += transport_fixtures
-    out += category_fixtures
-    out += activities_fixtures
 
-    write_json(path_fixtures, out)
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write the Django fixtures for the transit database "
+                    "and activities")
+    parser.add_argument('--format', choices=['json', 'jsonl'], default='json',
+                        help="a JSON list, or JSON Lines (default: json)")
+    parser.add_argument('--compact', action='store_true',
+                        help="don't indent the JSON list")
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="rows fetched from the database at a time "
+                             "(default: 1000)")
+    parser.add_argument('--output', help="defaults to {} or {}".format(
+        path_fixtures, path_fixtures_lines))
+    args = parser.parse_args()
+
+    output = args.output
+    if output is None:
+        output = path_fixtures_lines if args.format == 'jsonl' \
+            else path_fixtures
+    app_name = 'tourbuilder'
+    connect(path_transit_database)
+    write_fixtures(output, gen_fixtures(app_name, args.batch_size),
+                   args.format, None if args.compact else 2)
 
 
 if __name__ == "__main__":
@@ -36,10 +36,8 @@ elif [[ $# -eq 1 ]]; then
   elif [[ "${1}" == "--update" ]]; then
     echo "Updating database"
     cd -
-    python3 ./generate_database_fixtures.py
-    echo "Built the fixtures, starting to import"
-    python3 ./website/manage.py loaddata django_db_fixtures.json
-    echo "Finised importing fixtures"
+    python3 ./website/manage.py import_transit
+    echo "Finished importing"
   else
     echo "Unrecognised option"
   fi
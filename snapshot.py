@@ -0,0 +1,250 @@
+"""Versioned binary snapshots of the activities, stations and travel matrix.
+
+A snapshot is a header followed by sections at 8 byte aligned offsets
+worked out from the counts in the header, all little-endian. The header
+holds a CRC32 of everything after it. The travel matrices are read in
+place from a memory map, so processes loading the same snapshot share
+their pages. So is the index of the train ride taken between each pair of
+stations, for snapshots of the tourbuilder database.
+
+Times are microseconds from midnight, 1 January 1970 in Tokyo (UTC+9),
+durations are microseconds.
+"""
+
+from array import array
+import datetime
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+magic = b'TOURSNAP'
+version = 2
+# Set when the ids are those of the tourbuilder database
+has_database_ids = 1
+
+# magic, version, flags, stations, activities, rides, strings, size of the
+# strings, string index of the source, size of the body, checksum
+header = struct.Struct('<8sHHIIIIIIQI')
+# id, station index, station name, title, category, cost, duration,
+# available from, available until
+activity_record = struct.Struct('<qIIIII4xqqq')
+# id, from station index, to station index, cost, transfers, duration,
+# one way
+ride_record = struct.Struct('<qIIIIq?7x')
+
+epoch = datetime.datetime(1970, 1, 1,
+                          tzinfo=datetime.timezone(datetime.timedelta(hours=9)))
+
+
+def to_microseconds(value):
+    return value // datetime.timedelta(microseconds=1)
+
+
+def layout(stations, activities, rides, strings, strings_size):
+    """The (offset, size) of each section, and the size of the file."""
+    sizes = [
+        ('station_ids', 8 * stations),
+        ('station_pks', 8 * stations),
+        ('station_names', 4 * stations),
+        ('minutes', 2 * stations * stations),
+        ('costs', 2 * stations * stations),
+        ('transfers', stations * stations),
+        ('activities', activity_record.size * activities),
+        ('rides', ride_record.size * rides),
+        ('ride_index', 4 * stations * stations if rides else 0),
+        ('string_offsets', 4 * (strings + 1)),
+        ('strings', strings_size),
+    ]
+    sections = {}
+    offset = header.size
+    for name, size in sizes:
+        sections[name] = (offset, size)
+        offset += (size + 7) // 8 * 8
+    return sections, offset
+
+
+class Strings(object):
+    """Interns strings for a snapshot's string table."""
+
+    def __init__(self):
+        self.index = {}
+        self.data = []
+        self.offsets = [0]
+
+    def __call__(self, value):
+        index = self.index.get(value)
+        if index is None:
+            index = self.index[value] = len(self.data)
+            self.data.append(value.encode('utf-8'))
+            self.offsets.append(self.offsets[-1] + len(self.data[-1]))
+        return index
+
+
+def write(path, station_ids, station_names, minutes, costs, transfers,
+          activities, rides=(), station_pks=None, source=""):
+    """Write a snapshot to path.
+
+    minutes, costs and transfers are the flat travel matrices of a
+    builder.TravelMatrix. activities are (id, station index, station name,
+    title, category, cost, duration, available from, available until)
+    and rides (id, from station index, to station index, cost, transfers,
+    duration, one way), with times as datetimes and durations as
+    timedeltas. station_pks and rides are only given for snapshots of the
+    tourbuilder database. Between two stations the last one way ride given
+    is taken, or else the first ride both ways.
+    """
+    strings = Strings()
+    source_index = strings(source)
+    count = len(station_ids)
+    names = [strings(name) for name in station_names]
+    activity_data = bytearray()
+    for (activity_id, station, station_name, title, category, cost, duration,
+         available_from, available_until) in activities:
+        activity_data += activity_record.pack(
+            activity_id, station, strings(station_name), strings(title),
+            strings(category or ""), cost, to_microseconds(duration),
+            to_microseconds(available_from - epoch),
+            to_microseconds(available_until - epoch))
+    ride_data = bytearray()
+    rides = list(rides)
+    # The number of the ride taken from one station to another, counting
+    # from 1, or 0 for none
+    ride_index = array('I', bytes(4 * count * count)) if rides else array('I')
+    for number, ride in enumerate(rides, 1):
+        ride_data += ride_record.pack(*(ride[:5] + (
+            to_microseconds(ride[5]), ride[6])))
+        cells = [ride[1] * count + ride[2]]
+        if not ride[6]:
+            cells.append(ride[2] * count + ride[1])
+        for cell in cells:
+            if ride[6] or not ride_index[cell]:
+                ride_index[cell] = number
+    flags = 0 if station_pks is None else has_database_ids
+    if station_pks is None:
+        station_pks = [0] * count
+
+    sections = [
+        struct.pack('<{}q'.format(count), *station_ids),
+        struct.pack('<{}q'.format(count), *station_pks),
+        struct.pack('<{}I'.format(count), *names),
+        to_little_endian(minutes, 'H'),
+        to_little_endian(costs, 'H'),
+        bytes(transfers),
+        bytes(activity_data),
+        bytes(ride_data),
+        to_little_endian(ride_index, 'I'),
+        struct.pack('<{}I'.format(len(strings.offsets)), *strings.offsets),
+        b''.join(strings.data),
+    ]
+    body = bytearray()
+    for section in sections:
+        body += section
+        body += bytes(-len(section) % 8)
+    # Written under another name first, so a reader never sees half of it
+    writing = "{}.{}".format(path, os.getpid())
+    with open(writing, 'wb') as f:
+        f.write(header.pack(magic, version, flags, count,
+                            len(activity_data) // activity_record.size,
+                            len(ride_data) // ride_record.size,
+                            len(strings.data), strings.offsets[-1],
+                            source_index, len(body), zlib.crc32(body)))
+        f.write(body)
+    os.replace(writing, path)
+
+
+def to_little_endian(values, typecode):
+    data = memoryview(values).cast('B').cast(typecode)
+    if sys.byteorder == 'little':
+        return data.tobytes()
+    return struct.pack('<{}{}'.format(len(data), typecode), *data)
+
+
+class Snapshot(object):
+    """A snapshot file, memory mapped.
+
+    The station and matrix attributes are memoryviews into the file, and
+    stay valid for as long as the Snapshot does.
+    """
+
+    def __init__(self, path, verify=True):
+        if sys.byteorder != 'little':
+            raise ValueError("Snapshots can only be read on little-endian "
+                             "machines")
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < header.size:
+            raise ValueError("{} is not a tour snapshot".format(path))
+        (file_magic, file_version, self.flags, stations, activities, rides,
+         strings, strings_size, source, body_size,
+         checksum) = header.unpack_from(self.map)
+        if file_magic != magic:
+            raise ValueError("{} is not a tour snapshot".format(path))
+        if file_version != version:
+            raise ValueError("{} is a version {} snapshot, expected "
+                             "version {}".format(path, file_version, version))
+        sections, size = layout(stations, activities, rides, strings,
+                                strings_size)
+        if len(self.map) != size or header.size + body_size != size:
+            raise ValueError("{} is truncated".format(path))
+        view = memoryview(self.map)
+        if verify and zlib.crc32(view[header.size:]) != checksum:
+            raise ValueError("{} is corrupt".format(path))
+
+        def section(name, typecode='B'):
+            offset, size = sections[name]
+            return view[offset:offset + size].cast(typecode)
+
+        self.station_ids = section('station_ids', 'q')
+        self.station_pks = section('station_pks', 'q')
+        self.station_names = section('station_names', 'I')
+        self.minutes = section('minutes', 'H')
+        self.costs = section('costs', 'H')
+        self.transfers = section('transfers')
+        self.activity_data = section('activities')
+        self.ride_data = section('rides')
+        self.ride_index = section('ride_index', 'I')
+        self.string_offsets = section('string_offsets', 'I')
+        self.string_data = section('strings')
+        self.source = self.string(source)
+
+    @property
+    def has_database_ids(self):
+        return bool(self.flags & has_database_ids)
+
+    def string(self, index):
+        return str(self.string_data[self.string_offsets[index]:
+                                    self.string_offsets[index + 1]], 'utf-8')
+
+    def activities(self):
+        """(id, station index, station name, title, category, cost,
+        duration, available from, available until) of each activity."""
+        for (activity_id, station, station_name, title, category, cost,
+             duration, available_from,
+             available_until) in activity_record.iter_unpack(
+                 self.activity_data):
+            yield (activity_id, station, self.string(station_name),
+                   self.string(title), self.string(category), cost,
+                   datetime.timedelta(microseconds=duration),
+                   epoch + datetime.timedelta(microseconds=available_from),
+                   epoch + datetime.timedelta(microseconds=available_until))
+
+    def ride(self, from_index, to_index):
+        """The train ride taken from one station to the other, as for
+        rides(), or None."""
+        number = self.ride_index[from_index * len(self.station_ids) +
+                                 to_index]
+        if not number:
+            return None
+        ride = ride_record.unpack_from(self.ride_data,
+                                       (number - 1) * ride_record.size)
+        return ride[:5] + (datetime.timedelta(microseconds=ride[5]), ride[6])
+
+    def rides(self):
+        """(id, from station index, to station index, cost, transfers,
+        duration, one way) of each train ride."""
+        for ride in ride_record.iter_unpack(self.ride_data):
+            yield ride[:5] + (datetime.timedelta(microseconds=ride[5]),
+                              ride[6])
@@ -0,0 +1,203 @@
+"""Read-only access to the transit database (tokyo-transit.db).
+
+Lookups are parameterized and use covering indexes on the stations and
+routes. Missing indexes are added to the database when it can be written
+to, otherwise to a copy of it in a cache database.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+
+# Index name: (table, columns)
+indexes = {
+    'stations_english': ('stations', ('english', 'station_id')),
+    'routes_stations': ('routes', ('from_id', 'to_id', 'mins', 'cost',
+                                   'transfers')),
+    'one_way_routes_stations': ('one_way_routes', ('from_id', 'to_id', 'mins',
+                                                   'cost', 'transfers')),
+}
+tables = ['stations', 'routes', 'one_way_routes']
+
+# Values looked up per query. Every query has this many, so SQLite's
+# statement cache only ever sees one statement per lookup.
+batch_size = 200
+
+
+def file_uri(path, mode):
+    return "file:{}?mode={}".format(
+        os.path.abspath(path).replace('%', '%25').replace('?', '%3f')
+        .replace('#', '%23'), mode)
+
+
+def connect_read_only(path):
+    return sqlite3.connect(file_uri(path, 'ro'), uri=True)
+
+
+def default_cache_path(path):
+    path = os.path.abspath(path)
+    return os.path.join(tempfile.gettempdir(), "{}-{}.cache.db".format(
+        os.path.splitext(os.path.basename(path))[0],
+        hashlib.md5(path.encode()).hexdigest()[:12]))
+
+
+def batches(values):
+    # Lists of batch_size values, the last one padded with its last value
+    values = list(values)
+    for start in range(0, len(values), batch_size):
+        batch = values[start:start + batch_size]
+        yield batch + batch[-1:] * (batch_size - len(batch))
+
+
+class TransitDatabase(object):
+    """The stations and routes of a transit database.
+
+    Routes are stored once per pair of stations, in either direction. A
+    route in the optional one_way_routes table replaces the route between
+    its stations in its direction.
+    """
+
+    def __init__(self, path, cache_path=None):
+        self.path = path
+        self.cache_path = cache_path or default_cache_path(path)
+        self.conn = self.connect()
+        self.has_one_way_routes = self.has_table(self.conn, 'one_way_routes')
+
+    @staticmethod
+    def has_table(conn, name):
+        return conn.execute("SELECT 1 FROM sqlite_master "
+                            "WHERE type = 'table' AND name = ?",
+                            (name,)).fetchone() is not None
+
+    @classmethod
+    def missing_indexes(cls, conn):
+        existing = set(row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        return [name for name, (table, columns) in sorted(indexes.items())
+                if name not in existing and cls.has_table(conn, table)]
+
+    @staticmethod
+    def create_indexes(conn, names):
+        for name in names:
+            table, columns = indexes[name]
+            conn.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                name, table, ", ".join(columns)))
+
+    def connect(self):
+        conn = connect_read_only(self.path)
+        missing = self.missing_indexes(conn)
+        if not missing:
+            return conn
+        conn.close()
+        if os.access(self.path, os.W_OK):
+            with sqlite3.connect(self.path) as writable:
+                self.create_indexes(writable, missing)
+            writable.close()
+            return connect_read_only(self.path)
+        return self.connect_cache()
+
+    def connect_cache(self):
+        stat = os.stat(self.path)
+        version = "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+        if os.path.exists(self.cache_path):
+            conn = connect_read_only(self.cache_path)
+            try:
+                if conn.execute("SELECT version FROM cache").fetchone() == \
+                        (version,):
+                    return conn
+            except sqlite3.DatabaseError:
+                pass
+            conn.close()
+
+        # Build it under another name, so readers never see half of it
+        building = "{}.{}".format(self.cache_path, os.getpid())
+        if os.path.exists(building):
+            os.remove(building)
+        conn = sqlite3.connect(file_uri(building, 'rwc'), uri=True)
+        try:
+            conn.execute("ATTACH DATABASE ? AS source",
+                         (file_uri(self.path, 'ro'),))
+            for table in tables:
+                if conn.execute("SELECT 1 FROM source.sqlite_master "
+                                "WHERE type = 'table' AND name = ?",
+                                (table,)).fetchone() is not None:
+                    conn.execute("CREATE TABLE {0} AS SELECT * FROM source.{0} "
+                                 "ORDER BY rowid".format(table))
+            conn.execute("CREATE TABLE cache (version TEXT)")
+            conn.execute("INSERT INTO cache VALUES (?)", (version,))
+            self.create_indexes(conn, self.missing_indexes(conn))
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(building, self.cache_path)
+        return connect_read_only(self.cache_path)
+
+    def close(self):
+        self.conn.close()
+
+    def station_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM stations").fetchone()[0]
+
+    def stations(self):
+        """(station_id, name) of all stations."""
+        return self.conn.execute("SELECT station_id, english FROM stations "
+                                 "ORDER BY rowid")
+
+    def routes(self):
+        """(from_id, to_id, mins, cost, transfers, one_way) of all routes,
+        the one way routes last."""
+        query = ("SELECT from_id, to_id, mins, cost, transfers, 0 "
+                 "FROM routes")
+        if self.has_one_way_routes:
+            query += (" UNION ALL SELECT from_id, to_id, mins, cost, "
+                      "transfers, 1 FROM one_way_routes")
+        return self.conn.execute(query)
+
+    def get_station_ids(self, names):
+        """The station_id of each of names, by name. Names of more than one
+        station get the first, unknown names are left out."""
+        query = ("SELECT stations.rowid, english, station_id FROM ({}) AS names "
+                 "JOIN stations ON english = names.column1".format(
+                     values_list(batch_size, 1)))
+        rows = []
+        for batch in batches(set(names)):
+            rows.extend(self.conn.execute(query, batch))
+        out = {}
+        for rowid, name, station_id in sorted(rows):
+            out.setdefault(name, int(station_id))
+        return out
+
+    def get_routes(self, pairs):
+        """(mins, cost, transfers) of the route for each of the
+        (from_id, to_id) pairs that has one, by pair."""
+        pairs = set(pairs)
+        # Either direction can be stored, look for both
+        both = set(pairs)
+        both.update((to_id, from_id) for from_id, to_id in pairs)
+        out = {}
+        for row in sorted(self.find_routes('routes', both)):
+            from_id, to_id, route = int(row[1]), int(row[2]), row[3:]
+            for pair in ((from_id, to_id), (to_id, from_id)):
+                if pair in pairs:
+                    out.setdefault(pair, route)
+        if self.has_one_way_routes:
+            for row in sorted(self.find_routes('one_way_routes', pairs)):
+                out[(int(row[1]), int(row[2]))] = row[3:]
+        return out
+
+    def find_routes(self, table, pairs):
+        query = ("SELECT {0}.rowid, from_id, to_id, mins, cost, transfers "
+                 "FROM ({1}) AS pairs JOIN {0} "
+                 "ON from_id = pairs.column1 AND to_id = pairs.column2".format(
+                     table, values_list(batch_size, 2)))
+        rows = []
+        for batch in batches(pairs):
+            rows.extend(self.conn.execute(
+                query, [value for pair in batch for value in pair]))
+        return rows
+
+
+def values_list(rows, columns):
+    row = "({})".format(", ".join(["?"] * columns))
+    return "VALUES " + ", ".join([row] * rows)
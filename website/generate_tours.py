@@ -1,21 +1,169 @@
 #!/usr/bin/python3
 
+import argparse
+import collections
+import concurrent.futures
 import os
 import django
 import copy
 import datetime
+import itertools
 import pytz
+import sys
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "website.settings")
 django.setup()
 
+from django.db import connections, transaction
+from django.db.models import Count, Max
+from django.utils import timezone
 from tourbuilder.models import Activity, TrainRide, Location, Station, Tour
+from tourbuilder.models import Deletion
+from tourbuilder.models import Category, category_mask, station_summary
+from tourbuilder.search import data_version
+
+# builder.py and snapshot.py live in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import builder  # noqa: E402
+import snapshot  # noqa: E402
 
 tzone = pytz.timezone('Asia/Tokyo')
 day_start = datetime.datetime(1970, 1, 1, 0, 0, 0, tzinfo=tzone)
 day_end = datetime.datetime(1970, 1, 1, 23, 59, 59, tzinfo=tzone)
 
-activities = list(Activity.objects.all())
+# TrainRide by (from_station_id, to_station_id), loaded once by
+# get_train_rides() so the search doesn't query the database
+train_rides = None
+
+
+def load_train_rides(rides=None):
+    if rides is None:
+        rides = TrainRide.objects.order_by('one_way', 'id')
+    out = {}
+    # One way rides last, to replace the rides both ways between stations
+    for train_ride in rides:
+        for key in train_ride.directions():
+            if train_ride.one_way:
+                out[key] = train_ride
+            else:
+                out.setdefault(key, train_ride)
+    return out
+
+
+def get_train_rides():
+    global train_rides
+    if train_rides is None:
+        train_rides = load_train_rides()
+    return train_rides
+
+
+def load_activities():
+    return list(Activity.objects.select_related('train_station', 'category'))
+
+
+def write_snapshot(path):
+    """Compile the activities, stations and train rides of the database
+    into a snapshot file for load_snapshot."""
+    with transaction.atomic():
+        version = str(data_version())
+        activities = load_activities()
+        stations = list(Station.objects.order_by('id').values_list(
+            'id', 'station_id', 'name'))
+        rides = list(TrainRide.objects.order_by('one_way', 'id').values_list(
+            'id', 'from_station_id', 'to_station_id', 'cost', 'transfers',
+            'duration', 'one_way'))
+    index = {station[0]: position for position, station in enumerate(stations)}
+    matrix = builder.TravelMatrix([x[0] for x in stations],
+                                  [x[2] for x in stations])
+    for (ride_id, from_id, to_id, cost, transfers, duration,
+         one_way) in rides:
+        matrix.set_route(index[from_id], index[to_id],
+                         int(duration.total_seconds() // 60), cost, transfers,
+                         one_way)
+    snapshot.write(
+        path, [x[1] for x in stations], [x[2] for x in stations],
+        matrix.minutes, matrix.costs, matrix.transfers,
+        ((activity.id, index[activity.train_station_id],
+          activity.train_station.name, activity.title,
+          activity.category.title, activity.cost, activity.duration,
+          activity.available_from, activity.available_until)
+         for activity in activities),
+        ((ride[0], index[ride[1]], index[ride[2]]) + ride[3:]
+         for ride in rides),
+        station_pks=[x[0] for x in stations], source=version)
+
+
+class SnapshotTrainRides(object):
+    """The train rides of a snapshot by (from_station_id, to_station_id),
+    like load_train_rides().
+
+    Rides are read from the memory mapped snapshot when first asked for,
+    so workers loading the same snapshot share its pages.
+    """
+
+    def __init__(self, snap):
+        self.snapshot = snap
+        self.station_pks = snap.station_pks
+        self.index = {pk: index for index, pk in enumerate(snap.station_pks)}
+        self.rides = {}
+
+    def get(self, key, default=None):
+        ride = self.rides.get(key)
+        if ride is None:
+            from_id, to_id = key
+            if from_id not in self.index or to_id not in self.index:
+                return default
+            record = self.snapshot.ride(self.index[from_id], self.index[to_id])
+            if record is None:
+                return default
+            (ride_id, from_index, to_index, cost, transfers, duration,
+             one_way) = record
+            ride = self.rides[key] = TrainRide(
+                id=ride_id, from_station_id=self.station_pks[from_index],
+                to_station_id=self.station_pks[to_index], cost=cost,
+                transfers=transfers, duration=duration, one_way=one_way)
+        return ride
+
+
+def load_snapshot(path, check=True):
+    """The activities of a snapshot file as unsaved models, and its
+    SnapshotTrainRides. Unless check is False, the snapshot must have been
+    made from the database as it is now."""
+    snap = snapshot.Snapshot(path, verify=check)
+    if not snap.has_database_ids:
+        raise ValueError("{} wasn't made from the database".format(path))
+    if check and snap.source != str(data_version()):
+        raise ValueError("{} is out of date, make it again with "
+                         "--write-snapshot".format(path))
+    pks = snap.station_pks
+    stations = [Station(id=pk, location_ptr_id=pk, station_id=station_id,
+                        name=snap.string(name))
+                for pk, station_id, name in zip(pks, snap.station_ids,
+                                                snap.station_names)]
+    categories = {}
+    activities = []
+    for (activity_id, station, station_name, title, category, cost, duration,
+         available_from, available_until) in snap.activities():
+        if category not in categories:
+            categories[category] = Category(title=category)
+        activities.append(Activity(id=activity_id, title=title, cost=cost,
+                                   duration=duration,
+                                   available_from=available_from,
+                                   available_until=available_until,
+                                   train_station=stations[station],
+                                   category=categories[category]))
+    return activities, SnapshotTrainRides(snap)
+
+
+# A generated tour as sent back from a worker and saved to the database
+CompactTour = collections.namedtuple('CompactTour', [
+    'activity_ids',
+    'train_ride_ids',
+    'cost',
+    'duration',
+    'available_from',
+    'available_until',
+])
 
 
 class TourProto(object):
@@ -36,8 +184,27 @@ class TourProto(object):
         return available_from, available_until
 
     def can_probably_add_activity(self, activity):
-        # available_from, available_until = self.calculate_availability()
-        return True
+        # The tour can't start before available_from, and only gets longer,
+        # so an activity that would end after it closes can never be added
+        latest_start = activity.available_until - (self.duration + activity.duration)
+        if latest_start < self.available_from:
+            return False
+        return activity.available_from + activity.duration <= activity.available_until
+
+    def compact(self):
+        return CompactTour(tuple(activity.id for activity in self.activities),
+                           tuple(train_ride.id for train_ride in self.train_rides),
+                           self.cost,
+                           self.duration,
+                           self.available_from,
+                           self.available_until)
+
+    def score(self):
+        # Most activities, then cheapest
+        return (len(self.activities), -self.cost)
+
+    def best_possible_score(self, activities):
+        return (len(self.activities) + len(activities), -self.cost)
 
     def add_activity(self, activity):
         activity_total_cost = activity.cost
@@ -46,12 +213,9 @@ class TourProto(object):
         if len(self.activities) > 0:
             last_activity = self.activities[-1]
             if last_activity.train_station_id != activity.train_station_id:
-                out = TrainRide.objects.all()
-                out = out.filter(from_station_id=last_activity.train_station.id)
-                out = out.filter(to_station_id=activity.train_station.id)
-                if len(out) == 1:
-                    train_ride = out[0]
-                else:
+                train_ride = get_train_rides().get((last_activity.train_station_id,
+                                                    activity.train_station_id))
+                if train_ride is None:
                     print("Error fetching train ride {} to {}".format(last_activity.train_station.name,
                                                                       activity.train_station.name))
                 activity_total_cost += train_ride.cost
@@ -74,39 +238,306 @@ class TourProto(object):
             return False
 
 
-def build_tours(tours, tour, activities, depth=0):
+class Changes(object):
+    """Activities and train rides edited or deleted since the tours were
+    generated."""
+
+    def __init__(self, activity_ids=(), train_rides=(), tour_ids=()):
+        self.activity_ids = set(activity_ids)
+        self.train_ride_ids = set(train_ride_id
+                                  for train_ride_id, to_station_id in train_rides)
+        # A changed train ride can only be taken to reach an activity at
+        # its destination
+        self.station_ids = set(to_station_id
+                               for train_ride_id, to_station_id in train_rides)
+        # The tours that had a deleted activity or train ride
+        self.tour_ids = set(tour_ids)
+
+    @classmethod
+    def since(cls, when):
+        activities = Activity.objects.filter(updated_at__gt=when)
+        train_rides = list(TrainRide.objects.filter(updated_at__gt=when))
+        deletions = Deletion.objects.filter(deleted_at__gt=when)
+        # The rides between the stations of a deleted ride are taken
+        # instead of it, so they count as changed
+        pairs = set()
+        for from_station_id, to_station_id in deletions.exclude(
+                from_station_id=None).values_list('from_station_id',
+                                                  'to_station_id'):
+            pairs.add((from_station_id, to_station_id))
+            pairs.add((to_station_id, from_station_id))
+        stations = set(pair[0] for pair in pairs)
+        train_rides += [train_ride for train_ride in TrainRide.objects.filter(
+                            from_station_id__in=stations,
+                            to_station_id__in=stations)
+                        if (train_ride.from_station_id,
+                            train_ride.to_station_id) in pairs]
+        return cls(activities.values_list('id', flat=True),
+                   [(train_ride.id, to_station_id)
+                    for train_ride in train_rides
+                    for from_station_id, to_station_id
+                    in train_ride.directions()],
+                   Tour.objects.filter(deletion__in=deletions).values_list(
+                       'id', flat=True))
+
+    def __bool__(self):
+        return bool(self.activity_ids or self.train_ride_ids or self.tour_ids)
+
+    def touches(self, tour):
+        return (any(activity.id in self.activity_ids
+                    for activity in tour.activities) or
+                any(train_ride.id in self.train_ride_ids
+                    for train_ride in tour.train_rides))
+
+    def could_touch(self, tour, activities):
+        return (self.touches(tour) or
+                any(activity.id in self.activity_ids or
+                    activity.train_station_id in self.station_ids
+                    for activity in activities))
+
+    def stale_tours(self):
+        return (Tour.objects.filter(activities__in=self.activity_ids) |
+                Tour.objects.filter(train_rides__in=self.train_ride_ids) |
+                Tour.objects.filter(id__in=self.tour_ids)).distinct()
+
+
+class BestTours(builder.BestTours):
+    """Keeps the k best tours found so far in a min-heap, trying at most
+    max_nodes activities.
+
+    With changes, only tours that touch one of the changes are kept.
+    """
+
+    def __init__(self, k, max_nodes=None, changes=None):
+        super(BestTours, self).__init__(k, None)
+        self.nodes = 0
+        self.max_nodes = max_nodes
+        self.changes = changes
+
+    def out_of_nodes(self):
+        return self.max_nodes is not None and self.nodes >= self.max_nodes
+
+    def offer(self, tour):
+        if self.changes is None or self.changes.touches(tour):
+            self.push(tour.score(), tour)
+
+    def can_improve(self, tour, activities):
+        if (self.changes is not None and
+                not self.changes.could_touch(tour, activities)):
+            return False
+        if len(self.heap) < self.k:
+            return True
+        return tour.best_possible_score(activities) > self.heap[0][0]
+
+
+def build_tours(best, tour, activities, depth=0):
     depth += 1
-    print(len(tours))
-    if len(tours) > 100:
-        return
     activities = [x for x in activities if tour.can_probably_add_activity(x)]
+    if not best.can_improve(tour, activities):
+        return
 
     for index in range(len(activities)):
+        if best.out_of_nodes():
+            return
         tour_tmp = copy.deepcopy(tour)
         activities_tmp = copy.copy(activities)
         next_activity = activities_tmp[index]
         activities_tmp.remove(next_activity)
+        best.nodes += 1
         if tour_tmp.add_activity(next_activity):
-            tours.append(tour_tmp)
-            build_tours(tours, tour_tmp, activities_tmp, depth)
+            best.offer(tour_tmp)
+            build_tours(best, tour_tmp, activities_tmp, depth)
 
 
-tours = []
-for index in range(len(activities)):
+def generate_subtree(activities, index, k, max_nodes=None, changes=None):
+    # The best tours starting with activities[index], in the order they
+    # were found, as (score, CompactTour) pairs
+    best = BestTours(k, max_nodes, changes)
     tour_tmp = TourProto()
     activities_tmp = copy.copy(activities)
     if tour_tmp.add_activity(activities_tmp.pop(index)):
-        build_tours(tours, tour_tmp, activities_tmp)
-
-for proto_tour in tours:
-    tour = Tour()
-    tour.cost = proto_tour.cost
-    tour.duration = proto_tour.duration
-    tour.available_from = proto_tour.available_from
-    tour.available_until = proto_tour.available_until
-    tour.save()
-    for activity in proto_tour.activities:
-        tour.activities.add(activity)
-    for train_ride in proto_tour.train_rides:
-        tour.train_rides.add(train_ride)
-    tour.save()
+        build_tours(best, tour_tmp, activities_tmp)
+    return [(score, tour.compact())
+            for score, tour in best.entries_in_found_order()]
+
+
+worker_args = None
+
+
+def init_worker(activities, rides, k, max_nodes, changes, snapshot_path=None):
+    global worker_args, train_rides
+    # Don't share the parent's database connection
+    connections.close_all()
+    if snapshot_path is not None:
+        # Read from the snapshot rather than sent to each worker
+        activities, rides = load_snapshot(snapshot_path, check=False)
+    train_rides = rides
+    worker_args = (activities, k, max_nodes, changes)
+
+
+def generate_worker(index):
+    activities, k, max_nodes, changes = worker_args
+    return generate_subtree(activities, index, k, max_nodes, changes)
+
+
+def generate_tours(activities, k, max_nodes=None, workers=1, changes=None,
+                   best=None, snapshot_path=None):
+    # With snapshot_path, activities and the train rides were loaded from
+    # that snapshot, and workers load them from it too
+    # Each first activity gets an equal share of the node budget, so that
+    # the results don't depend on how the search is split between workers
+    root_nodes = None
+    if max_nodes is not None:
+        root_nodes = max(1, max_nodes // max(1, len(activities)))
+    roots = range(len(activities))
+    if best is None:
+        best = BestTours(k)
+    if workers > 1:
+        initargs = (activities, get_train_rides(), k, root_nodes, changes)
+        if snapshot_path is not None:
+            initargs = (None, None, k, root_nodes, changes, snapshot_path)
+        connections.close_all()
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=init_worker,
+                initargs=initargs) as executor:
+            for subtree in executor.map(generate_worker, roots):
+                for score, tour in subtree:
+                    best.push(score, tour)
+    else:
+        for index in roots:
+            for score, tour in generate_subtree(activities, index, k,
+                                                root_nodes, changes):
+                best.push(score, tour)
+    return best.tours()
+
+
+def save_tours(compact_tours, batch_size=1000, generated_at=None):
+    if generated_at is None:
+        generated_at = timezone.now()
+    TourActivity = Tour.activities.through
+    TourTrainRide = Tour.train_rides.through
+    activity_categories = {}
+    activity_stations = {}
+    for activity_id, category_id, station_id in Activity.objects.values_list(
+            'id', 'category_id', 'train_station_id'):
+        activity_categories[activity_id] = category_id
+        activity_stations[activity_id] = station_id
+    compact_tours = iter(compact_tours)
+    # The database hands out the ids, so the ids of deleted tours aren't
+    # reused. Where bulk_create doesn't set them, tours are saved one by one.
+    features = connections[Tour.objects.db].features
+    returns_ids = features.can_return_rows_from_bulk_insert
+    with transaction.atomic():
+        while True:
+            batch = list(itertools.islice(compact_tours, batch_size))
+            if not batch:
+                break
+            tours = []
+            for compact_tour in batch:
+                activity_ids = compact_tour.activity_ids
+                tours.append(Tour(cost=compact_tour.cost,
+                                  duration=compact_tour.duration,
+                                  available_from=compact_tour.available_from,
+                                  available_until=compact_tour.available_until,
+                                  generated_at=generated_at,
+                                  category_mask=category_mask(
+                                      activity_categories[x] for x in activity_ids),
+                                  station_ids=station_summary(
+                                      activity_stations[x] for x in activity_ids)))
+            if returns_ids:
+                Tour.objects.bulk_create(tours, batch_size)
+            else:
+                for tour in tours:
+                    tour.save()
+            tour_activities = []
+            tour_train_rides = []
+            for tour, compact_tour in zip(tours, batch):
+                tour_activities.extend(
+                    TourActivity(tour_id=tour.id, activity_id=activity_id)
+                    for activity_id in set(compact_tour.activity_ids))
+                tour_train_rides.extend(
+                    TourTrainRide(tour_id=tour.id, trainride_id=train_ride_id)
+                    for train_ride_id in set(compact_tour.train_ride_ids))
+            TourActivity.objects.bulk_create(tour_activities, batch_size)
+            TourTrainRide.objects.bulk_create(tour_train_rides, batch_size)
+
+
+def update_tours(activities, k, max_nodes=None, workers=1, batch_size=1000,
+                 snapshot_path=None):
+    """Regenerate only the tours affected by activities and train rides
+    changed since the last run.
+
+    The stored tours that don't touch a change are kept and compete with
+    the regenerated ones for the k places. Tours that were cut from the
+    last run aren't recovered, a full run is needed for that.
+    """
+    started = timezone.now()
+    since = Tour.objects.aggregate(Max('generated_at'))['generated_at__max']
+    if since is None:
+        save_tours(generate_tours(activities, k, max_nodes, workers,
+                                  snapshot_path=snapshot_path),
+                   batch_size, started)
+        return
+    changes = Changes.since(since)
+    if not changes:
+        return
+
+    stale_ids = set(changes.stale_tours().values_list('id', flat=True))
+    best = BestTours(k)
+    kept = Tour.objects.exclude(id__in=stale_ids)
+    kept = kept.annotate(num_activities=Count('activities')).order_by('id')
+    for tour in kept:
+        best.push((tour.num_activities, -tour.cost), tour.id)
+    tours = generate_tours(activities, k, max_nodes, workers, changes, best,
+                           snapshot_path)
+    kept_ids = [tour for tour in tours if isinstance(tour, int)]
+    with transaction.atomic():
+        Tour.objects.exclude(id__in=kept_ids).delete()
+        Tour.objects.update(generated_at=started)
+        save_tours([tour for tour in tours if isinstance(tour, CompactTour)],
+                   batch_size, started)
+        Deletion.objects.filter(deleted_at__lte=started).delete()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate tours into the database")
+    parser.add_argument('--best', type=int, default=100, metavar='K',
+                        help="number of tours to keep (default: 100)")
+    parser.add_argument('--max-nodes', type=int, default=100000,
+                        help="stop searching after trying this many "
+                             "activities (default: 100000)")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="search in N processes")
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="rows written per insert (default: 1000)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only regenerate tours affected by activities "
+                             "and train rides changed since the last run")
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help="read the activities and train rides from a "
+                             "snapshot made with --write-snapshot")
+    parser.add_argument('--write-snapshot', metavar='FILE',
+                        help="compile the activities, stations and train "
+                             "rides into a snapshot FILE and exit")
+    args = parser.parse_args()
+
+    if args.write_snapshot:
+        write_snapshot(args.write_snapshot)
+        sys.exit()
+    if args.snapshot:
+        try:
+            activities, train_rides = load_snapshot(args.snapshot)
+        except ValueError as error:
+            parser.error(str(error))
+    else:
+        activities = load_activities()
+    if args.incremental:
+        update_tours(activities, args.best, args.max_nodes, args.workers,
+                     args.batch_size, args.snapshot)
+    else:
+        # Stamped with the start, so the next --incremental run picks up
+        # the changes made while this one was running
+        started = timezone.now()
+        save_tours(generate_tours(activities, args.best, args.max_nodes,
+                                  args.workers, snapshot_path=args.snapshot),
+                   args.batch_size, started)
@@ -0,0 +1,175 @@
+import os
+import sys
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from tourbuilder.models import Activity, Category, Location, Station, TrainRide
+
+# generate_database_fixtures.py lives in the root of the repository
+root = os.path.dirname(settings.BASE_DIR)
+sys.path.insert(0, root)
+import generate_database_fixtures as fixtures  # noqa: E402
+
+# In the order they are saved, so each is saved after the rows it refers to
+models = [Location, Station, Category, TrainRide, Activity]
+# Models whose updated_at is only bumped when they change, as on save
+tracked_models = [Activity, TrainRide]
+
+
+def drop_indexes(model):
+    """Drop the indexes of model's table and return the SQL to create them
+    again. Only SQLite can list them, elsewhere nothing is dropped."""
+    if connection.vendor != 'sqlite':
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name, sql FROM sqlite_master "
+                       "WHERE type = 'index' AND tbl_name = %s "
+                       "AND sql IS NOT NULL", [model._meta.db_table])
+        indexes = cursor.fetchall()
+        for name, sql in indexes:
+            cursor.execute("DROP INDEX {}".format(
+                connection.ops.quote_name(name)))
+    return [sql for name, sql in indexes]
+
+
+class Table(object):
+    """The rows of one model's table waiting to be saved, as the values
+    loaddata would save for its fixtures. Rows already in the table are
+    updated."""
+
+    def __init__(self, model):
+        self.model = model
+        meta = model._meta
+        # A Station's table only has its own fields, name is in Location's
+        self.fields = [field for field in meta.local_concrete_fields
+                       if field is not meta.pk and field.name != 'updated_at']
+        self.tracked = model in tracked_models
+        columns = [meta.pk.column] + [field.column for field in self.fields]
+        if self.tracked:
+            columns.append(meta.get_field('updated_at').column)
+        quote = connection.ops.quote_name
+        self.sql = ("INSERT INTO {} ({}) VALUES ({}) "
+                    "ON CONFLICT ({}) DO UPDATE SET {}".format(
+                        quote(meta.db_table),
+                        ", ".join(map(quote, columns)),
+                        ", ".join(["%s"] * len(columns)),
+                        quote(columns[0]),
+                        ", ".join("{0} = excluded.{0}".format(quote(column))
+                                  for column in columns[1:])))
+        self.rows = []
+        self.count = 0
+        self.ids = set()
+        # Most values repeat, train rides have few distinct times and costs
+        self.prepared = {}
+        self.saved = {}
+        if self.tracked:
+            # The values and updated_at of the saved rows by id
+            updated_at = meta.get_field('updated_at')
+            self.now = self.prepare(updated_at, timezone.now())[1]
+            for row in model.objects.values_list(
+                    'pk', 'updated_at',
+                    *[field.attname for field in self.fields]).iterator():
+                self.saved[row[0]] = (row[2:],
+                                      self.prepare(updated_at, row[1])[1])
+
+    def prepare(self, field, value):
+        # The value as a Python object, and as saved in the database
+        key = (field.name, value)
+        prepared = self.prepared.get(key)
+        if prepared is None:
+            value = field.to_python(value)
+            prepared = (value, field.get_db_prep_save(value, connection))
+            self.prepared[key] = prepared
+        return prepared
+
+    def add(self, fixture):
+        values = fixture['fields']
+        pk = self.model._meta.pk.to_python(fixture['pk'])
+        prepared = [self.prepare(field, values[field.name])
+                    if field.name in values else
+                    self.prepare(field, field.get_default())
+                    for field in self.fields]
+        row = (pk,) + tuple(value[1] for value in prepared)
+        if self.tracked:
+            # As touch_updated_at, which is only sent by save
+            saved = self.saved.get(pk)
+            if saved is not None and \
+                    saved[0] == tuple(value[0] for value in prepared):
+                row += (saved[1],)
+            else:
+                row += (self.now,)
+        self.rows.append(row)
+        self.ids.add(pk)
+
+    def save(self):
+        if self.rows:
+            with connection.cursor() as cursor:
+                cursor.executemany(self.sql, self.rows)
+            self.count += len(self.rows)
+            self.rows = []
+
+    def delete_others(self):
+        """Delete the saved rows that weren't imported, returns how many."""
+        ids = sorted(set(self.saved) - self.ids)
+        for start in range(0, len(ids), 500):
+            self.model.objects.filter(id__in=ids[start:start + 500]).delete()
+        return len(ids)
+
+
+class Command(BaseCommand):
+    help = ("Import the stations and routes of the transit database and the "
+            "activities straight into the database, the same as loading the "
+            "fixtures of generate_database_fixtures.py but much faster")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--transit-db',
+            default=os.path.join(root, fixtures.path_transit_database),
+            help="the transit database (default: %(default)s)")
+        parser.add_argument(
+            '--activities',
+            default=os.path.join(root, fixtures.path_activities),
+            help="the activities CSV (default: %(default)s)")
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="rows saved at a time (default: 5000)")
+
+    def handle(self, *args, **options):
+        for path in (options['transit_db'], options['activities']):
+            if not os.path.isfile(path):
+                raise CommandError("Can't find {}".format(path))
+        fixtures.connect(options['transit_db'])
+        fixtures.path_activities = options['activities']
+        batch_size = options['batch_size']
+
+        with transaction.atomic():
+            tables = {}
+            indexes = []
+            for model in models:
+                tables[model] = Table(model)
+                indexes += drop_indexes(model)
+            for fixture in fixtures.gen_fixtures('tourbuilder', batch_size):
+                table = tables[apps.get_model(fixture['model'])]
+                table.add(fixture)
+                if len(table.rows) >= batch_size:
+                    # All of them, so rows are saved after those they refer to
+                    for model in models:
+                        tables[model].save()
+            for model in models:
+                tables[model].save()
+            # Routes are numbered in the order of the transit database, so
+            # rides from an older one can be left over
+            deleted = tables[TrainRide].delete_others()
+            with connection.cursor() as cursor:
+                for sql in indexes:
+                    cursor.execute(sql)
+        fixtures.conn.close()
+
+        self.stdout.write("Imported {} stations, {} train rides, {} categories "
+                          "and {} activities, deleted {} old train rides".format(
+                              tables[Station].count, tables[TrainRide].count,
+                              tables[Category].count, tables[Activity].count,
+                              deleted))
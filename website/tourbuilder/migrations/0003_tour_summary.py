@@ -0,0 +1,55 @@
+# Generated by Django 3.0.6 on 2026-10-17 10:05
+
+from django.db import migrations, models
+
+
+def fill_tour_summaries(apps, schema_editor):
+    Tour = apps.get_model('tourbuilder', 'Tour')
+    TourActivity = Tour.activities.through
+    categories = {}
+    stations = {}
+    rows = TourActivity.objects.values_list(
+        'tour_id', 'activity__category_id', 'activity__train_station_id')
+    for tour_id, category_id, station_id in rows.iterator():
+        categories.setdefault(tour_id, set()).add(category_id)
+        stations.setdefault(tour_id, set()).add(station_id)
+    for tour_id in categories:
+        mask = 0
+        for category_id in categories[tour_id]:
+            mask |= 1 << (category_id - 1)
+        station_ids = ",{},".format(",".join(map(str, sorted(stations[tour_id]))))
+        Tour.objects.filter(pk=tour_id).update(category_mask=mask,
+                                               station_ids=station_ids)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tourbuilder', '0002_change_tracking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tour',
+            name='category_mask',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tour',
+            name='station_ids',
+            field=models.CharField(blank=True, default='', max_length=500),
+        ),
+        migrations.AddIndex(
+            model_name='tour',
+            index=models.Index(fields=['cost', 'id'], name='tourbuilder_cost_673e53_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tour',
+            index=models.Index(fields=['duration', 'id'], name='tourbuilder_duratio_154af8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tour',
+            index=models.Index(fields=['available_from', 'available_until'], name='tourbuilder_availab_6b74c3_idx'),
+        ),
+        migrations.RunPython(fill_tour_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 3.0.6 on 2026-10-17 20:20
+
+from django.db import migrations, models
+
+
+def chunks(ids, size=500):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def merge_train_rides(apps, schema_editor):
+    # Keep one ride for each pair of stations that had the same ride both
+    # ways, and make the rest one way so they are only taken as before
+    TrainRide = apps.get_model('tourbuilder', 'TrainRide')
+    TourTrainRide = apps.get_model('tourbuilder', 'Tour').train_rides.through
+    rides = {}
+    merged = {}
+    for ride in TrainRide.objects.order_by('id').iterator():
+        key = (ride.from_station_id, ride.to_station_id)
+        if key in rides:
+            # Only the first ride between two stations was ever taken
+            merged[ride.id] = rides[key].id
+        else:
+            rides[key] = ride
+
+    one_way = []
+    for (a, b), ride in rides.items():
+        # A ride from a station to itself is its own way back
+        if a >= b:
+            continue
+        back = rides.get((b, a))
+        if back is None:
+            one_way.append(ride.id)
+        elif (back.duration, back.cost, back.transfers) == \
+                (ride.duration, ride.cost, ride.transfers):
+            merged[back.id] = ride.id
+        else:
+            one_way.append(back.id)
+    for (a, b), ride in rides.items():
+        if a > b and (b, a) not in rides:
+            one_way.append(ride.id)
+
+    for ride_id in merged:
+        while merged[ride_id] in merged:
+            merged[ride_id] = merged[merged[ride_id]]
+
+    # Point the tours at the rides that are kept, unless they already are
+    rows = TourTrainRide.objects.values_list('id', 'tour_id', 'trainride_id')
+    links = set((tour_id, ride_id) for link_id, tour_id, ride_id
+                in rows.iterator() if ride_id not in merged)
+    moved = {}
+    for link_id, tour_id, ride_id in rows.iterator():
+        if ride_id in merged and (tour_id, merged[ride_id]) not in links:
+            links.add((tour_id, merged[ride_id]))
+            moved.setdefault(merged[ride_id], []).append(link_id)
+    for ride_id, link_ids in moved.items():
+        for chunk in chunks(link_ids):
+            TourTrainRide.objects.filter(id__in=chunk).update(
+                trainride_id=ride_id)
+    for chunk in chunks(merged):
+        TrainRide.objects.filter(id__in=chunk).delete()
+    for chunk in chunks(one_way):
+        TrainRide.objects.filter(id__in=chunk).update(one_way=True)
+
+
+def split_train_rides(apps, schema_editor):
+    TrainRide = apps.get_model('tourbuilder', 'TrainRide')
+    keys = set(TrainRide.objects.values_list('from_station_id',
+                                             'to_station_id'))
+    back = []
+    for ride in TrainRide.objects.filter(one_way=False).iterator():
+        if (ride.to_station_id, ride.from_station_id) not in keys:
+            back.append(TrainRide(from_station_id=ride.to_station_id,
+                                  to_station_id=ride.from_station_id,
+                                  duration=ride.duration, cost=ride.cost,
+                                  transfers=ride.transfers,
+                                  updated_at=ride.updated_at))
+    TrainRide.objects.bulk_create(back, 500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tourbuilder', '0003_tour_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trainride',
+            name='one_way',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='trainride',
+            index=models.Index(fields=['from_station', 'to_station'], name='tourbuilder_from_st_e1ad4a_idx'),
+        ),
+        migrations.RunPython(merge_train_rides, split_train_rides),
+    ]
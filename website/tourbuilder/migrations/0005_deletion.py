@@ -0,0 +1,24 @@
+# Generated by Django 3.0.6 on 2026-10-17 21:09
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tourbuilder', '0004_symmetric_train_rides'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Deletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('deleted_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('from_station_id', models.IntegerField(null=True)),
+                ('to_station_id', models.IntegerField(null=True)),
+                ('tours', models.ManyToManyField(to='tourbuilder.Tour')),
+            ],
+        ),
+    ]
@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.signals import m2m_changed, pre_delete, pre_save
+from django.dispatch import receiver
 from django.utils import timezone
 import datetime
 import pytz
@@ -36,12 +38,19 @@ class Activity(models.Model):
     cost = models.PositiveIntegerField(default=0)
     duration = models.DurationField(default=datetime.timedelta)
     title = models.CharField(max_length=50)
+    updated_at = models.DateTimeField(default=timezone.now, db_index=True)
 
     def __str__(self):
         return self.title
 
 
 class TrainRide(models.Model):
+    """A ride between two stations, taken either way.
+
+    Rides going both ways are stored once, from the station with the lower
+    id. A one_way ride only goes from from_station to to_station, and is
+    taken instead of the ride going both ways between them.
+    """
     from_station = models.ForeignKey(Station,
                                      related_name='from_station',
                                      on_delete=models.CASCADE)
@@ -51,9 +60,54 @@ class TrainRide(models.Model):
     duration = models.DurationField(default=datetime.timedelta)
     cost = models.PositiveIntegerField(default=0)
     transfers = models.PositiveIntegerField(default=0)
+    one_way = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['from_station', 'to_station']),
+        ]
 
     def __str__(self):
-        return "{} to {}".format(self.from_station.name, self.to_station.name)
+        return "{} {} {}".format(self.from_station.name,
+                                 "to" if self.one_way else "and",
+                                 self.to_station.name)
+
+    def save(self, *args, **kwargs):
+        if not self.one_way and self.from_station_id > self.to_station_id:
+            self.from_station_id, self.to_station_id = \
+                self.to_station_id, self.from_station_id
+        super(TrainRide, self).save(*args, **kwargs)
+
+    def directions(self):
+        """The (from_station_id, to_station_id) the ride can be taken for."""
+        if self.one_way:
+            return [(self.from_station_id, self.to_station_id)]
+        return [(self.from_station_id, self.to_station_id),
+                (self.to_station_id, self.from_station_id)]
+
+
+def category_bit(category_id):
+    # Category.id 1 to 63 map onto the bits of a signed 64 bit integer
+    if not 0 < category_id < 64:
+        raise ValueError("Category id {} doesn't fit in a category mask".format(
+            category_id))
+    return 1 << (category_id - 1)
+
+
+def category_mask(category_ids):
+    mask = 0
+    for category_id in category_ids:
+        mask |= category_bit(category_id)
+    return mask
+
+
+def station_summary(station_ids):
+    # ",3,17," so that a station is found with contains=",17,"
+    station_ids = sorted(set(station_ids))
+    if not station_ids:
+        return ""
+    return ",{},".format(",".join(map(str, station_ids)))
 
 
 class Tour(models.Model):
@@ -63,6 +117,86 @@ class Tour(models.Model):
     cost = models.PositiveIntegerField(default=0)
     duration = models.DurationField(default=datetime.timedelta)
     train_rides = models.ManyToManyField(TrainRide)
+    generated_at = models.DateTimeField(default=timezone.now)
+    # Summaries of the activities, so filtering doesn't join through them
+    category_mask = models.BigIntegerField(default=0)
+    station_ids = models.CharField(max_length=500, default="", blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['cost', 'id']),
+            models.Index(fields=['duration', 'id']),
+            models.Index(fields=['available_from', 'available_until']),
+        ]
 
     def __str__(self):
         return "{} - {}".format(self.duration, ", ".join(map(str, self.activities.all())))
+
+    def update_summary(self):
+        activities = self.activities.values_list('category_id', 'train_station_id')
+        self.category_mask = category_mask(x[0] for x in activities)
+        self.station_ids = station_summary(x[1] for x in activities)
+        self.save(update_fields=['category_mask', 'station_ids'])
+
+
+class Deletion(models.Model):
+    """A deleted activity or train ride and the tours that had it, so that
+    generate_tours.py --incremental regenerates them.
+
+    The stations are those of a deleted train ride, as other rides between
+    them can be taken instead.
+    """
+    deleted_at = models.DateTimeField(default=timezone.now, db_index=True)
+    tours = models.ManyToManyField(Tour)
+    from_station_id = models.IntegerField(null=True)
+    to_station_id = models.IntegerField(null=True)
+
+
+@receiver(pre_save, sender=Activity)
+@receiver(pre_save, sender=TrainRide)
+def touch_updated_at(sender, instance, **kwargs):
+    # Also runs for loaddata, so reloading unchanged fixtures keeps the
+    # old updated_at and doesn't invalidate any tours
+    fields = [field.attname for field in sender._meta.concrete_fields
+              if field.name not in ('id', 'updated_at')]
+    old = None
+    if instance.pk is not None:
+        old = sender.objects.filter(pk=instance.pk).values(
+            'updated_at', *fields).first()
+    if old is None or any(old[name] != getattr(instance, name)
+                          for name in fields):
+        instance.updated_at = timezone.now()
+    else:
+        instance.updated_at = old['updated_at']
+
+
+@receiver(m2m_changed, sender=Tour.activities.through)
+def update_tour_summary(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            instance.update_summary()
+        return
+    # Removing an activity from its tours, pk_set holds tour ids
+    if action == 'pre_clear':
+        instance._cleared_tour_ids = list(
+            instance.tour_set.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('_cleared_tour_ids', ())
+        for tour in Tour.objects.filter(pk__in=pk_set):
+            tour.update_summary()
+
+
+@receiver(pre_delete, sender=Activity)
+@receiver(pre_delete, sender=TrainRide)
+def record_deletion(sender, instance, **kwargs):
+    # Before the links from the tours are deleted along with it
+    tour_ids = list(instance.tour_set.values_list('id', flat=True))
+    if sender is Activity and not tour_ids:
+        return
+    deletion = Deletion()
+    if sender is TrainRide:
+        deletion.from_station_id = instance.from_station_id
+        deletion.to_station_id = instance.to_station_id
+    deletion.save()
+    deletion.tours.set(tour_ids)
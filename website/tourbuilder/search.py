@@ -0,0 +1,311 @@
+import collections
+import concurrent.futures
+import datetime
+import os
+import sys
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Activity, Station, TrainRide
+
+# builder.py lives in the root of the repository
+sys.path.insert(0, os.path.dirname(settings.BASE_DIR))
+import builder  # noqa: E402
+
+
+cache_size = 256
+cache_ttl = 600
+time_limit = 2.0
+max_tours = 50
+# Searches run as jobs get longer, and report their best tours so far
+job_time_limit = 30.0
+job_progress_interval = 0.5
+max_jobs = 100
+
+# builder keeps its travel matrix in a global, read by snapshot reloads,
+# new TourSearches and replay_tour, so those take turns. A running search
+# only uses the matrix it started with and doesn't need the lock.
+search_lock = threading.Lock()
+
+
+class TourCache(object):
+    """Least recently used cache whose entries expire after ttl seconds.
+
+    generation goes up each time it's cleared, set() drops values computed
+    before the last clear.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+
+def data_version():
+    # Changes whenever an activity or train ride is saved, added or deleted
+    return (Activity.objects.aggregate(Max('updated_at'), Count('id')),
+            TrainRide.objects.aggregate(Max('updated_at'), Count('id')))
+
+
+def local_time(value):
+    value = timezone.localtime(value)
+    return builder.time(value.hour, value.minute, value.second)
+
+
+class Snapshot(object):
+    """The activities and travel matrix of the database, in builder's
+    classes."""
+
+    def __init__(self):
+        self.version = data_version()
+        stations = list(Station.objects.values_list('station_id', 'name'))
+        self.matrix = builder.TravelMatrix([x[0] for x in stations],
+                                           [x[1] for x in stations])
+        rides = TrainRide.objects.values_list('from_station__station_id',
+                                              'to_station__station_id',
+                                              'duration', 'cost', 'transfers',
+                                              'one_way')
+        for from_id, to_id, duration, cost, transfers, one_way in rides:
+            self.matrix.set_route(self.matrix.id_to_index[from_id],
+                                  self.matrix.id_to_index[to_id],
+                                  int(duration.total_seconds() // 60),
+                                  cost, transfers, one_way)
+        builder.travel_matrix = self.matrix
+        self.activities = [
+            builder.Activity(title=activity.title,
+                             location=builder.Station(activity.train_station.name),
+                             duration=activity.duration,
+                             cost=activity.cost,
+                             available_from=local_time(activity.available_from),
+                             available_until=local_time(activity.available_until),
+                             category=activity.category.title)
+            for activity in Activity.objects.select_related(
+                'train_station', 'category').order_by('id')]
+
+
+snapshot = None
+cache = TourCache(cache_size, cache_ttl)
+
+
+@receiver(post_save, sender=Activity)
+@receiver(post_save, sender=TrainRide)
+@receiver(post_save, sender=Station)
+@receiver(post_delete, sender=Activity)
+@receiver(post_delete, sender=TrainRide)
+@receiver(post_delete, sender=Station)
+def invalidate(**kwargs):
+    # Without search_lock, saves don't wait for a running search. Its
+    # results aren't cached, as the cache's generation has moved on.
+    global snapshot
+    snapshot = None
+    cache.clear()
+
+
+def parse_time(value):
+    return datetime.datetime.strptime(value, "%H:%M").time()
+
+
+def normalize_spec(params):
+    """The search parameters in params as a hashable key, raises
+    ValueError for invalid ones."""
+    def optional(name, parse):
+        value = params.get(name)
+        return parse(value) if value else None
+
+    spec = (
+        parse_time(params.get('start', '08:00')),
+        optional('min_end', parse_time),
+        optional('max_end', parse_time),
+        optional('min_cost', int),
+        optional('max_cost', int),
+        int(params.get('num_people', 1)),
+        min(int(params.get('best', 10)), max_tours),
+        params.get('score', 'activities'),
+    )
+    if spec[5] < 1 or spec[6] < 1:
+        raise ValueError("num_people and best must be positive")
+    if spec[7] not in builder.tour_scores:
+        raise ValueError("Unknown score {}".format(spec[7]))
+    return spec
+
+
+def make_specs(spec):
+    start, min_end, max_end, min_cost, max_cost, num_people = spec[:6]
+    specs = builder.Specifications(num_people=num_people, start_time=start)
+    if min_end is not None:
+        specs.set_min_end_time(min_end)
+    if max_end is not None:
+        specs.set_max_end_time(max_end)
+    if min_cost is not None:
+        specs.set_min_cost(min_cost)
+    if max_cost is not None:
+        specs.set_max_cost(max_cost)
+    return specs
+
+
+def run_search(spec, limit, progress=None):
+    """Search for the best tours for a normalized spec, giving up after
+    limit seconds, and cache them as (tour dicts, complete).
+
+    progress, if given, is called with the best tours so far every
+    job_progress_interval seconds.
+    """
+    global snapshot
+    with search_lock:
+        generation = cache.generation
+        # Kept here, invalidate() can reset snapshot during the search
+        data = snapshot
+        # The data may have been reloaded by another process
+        if data is None or data.version != data_version():
+            cache.clear()
+            generation = cache.generation
+            data = snapshot = Snapshot()
+        builder.travel_matrix = data.matrix
+        specs = make_specs(spec)
+        best = builder.BestTours(spec[6], builder.tour_scores[spec[7]])
+        tour_search = builder.TourSearch(specs, data.activities, best=best,
+                                         compact=True)
+
+    def replay(paths):
+        with search_lock:
+            builder.travel_matrix = data.matrix
+            return [builder.replay_tour(specs, data.activities, path).as_dict()
+                    for path in paths]
+
+    reported = time.monotonic()
+    for path in tour_search.until(tour_search.iter_paths(), reported + limit):
+        if progress is not None and \
+                time.monotonic() - reported >= job_progress_interval:
+            progress(replay(best.tours()))
+            reported = time.monotonic()
+    result = (replay(tour_search.results()), tour_search.complete)
+    cache.set(spec, result, generation)
+    return result
+
+
+def search(spec):
+    """The best tours for a normalized spec as (tour dicts, complete),
+    along with whether they came from the cache."""
+    result = cache.get(spec)
+    if result is not None:
+        return result, True
+    return run_search(spec, time_limit), False
+
+
+class SearchJob(object):
+    """A search running in the background, with its best tours so far.
+
+    version goes up with every change, wait() blocks until it does.
+    """
+
+    def __init__(self, spec):
+        self.id = uuid.uuid4().hex
+        self.spec = spec
+        self.status = 'queued'
+        self.tours = []
+        self.complete = False
+        self.error = None
+        self.version = 0
+        self.changed = threading.Condition()
+
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def update(self, **fields):
+        with self.changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait(self, version, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+
+    def as_dict(self):
+        with self.changed:
+            return {
+                'id': self.id,
+                'status': self.status,
+                'version': self.version,
+                'tours': self.tours,
+                'complete': self.complete,
+                'error': self.error,
+            }
+
+    def run(self):
+        try:
+            result = cache.get(self.spec)
+            if result is None:
+                self.update(status='running')
+                result = run_search(self.spec, job_time_limit,
+                                    lambda tours: self.update(tours=tours))
+            tours, complete = result
+            self.update(status='done', tours=tours, complete=complete)
+        except Exception as error:
+            self.update(status='failed', error=str(error))
+            raise
+        finally:
+            # Each executor thread has its own database connection
+            connection.close()
+
+
+# One job searches at a time, searches share the GIL anyway
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+jobs = collections.OrderedDict()
+jobs_lock = threading.Lock()
+
+
+def start_job(spec):
+    job = SearchJob(spec)
+    with jobs_lock:
+        jobs[job.id] = job
+        # Forget the oldest finished jobs
+        for old in list(jobs.values()):
+            if len(jobs) <= max_jobs:
+                break
+            if old.finished():
+                del jobs[old.id]
+    job.future = executor.submit(job.run)
+    return job
+
+
+def get_job(job_id):
+    with jobs_lock:
+        return jobs.get(job_id)
@@ -1,3 +1,1011 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import copy
+import csv
+import datetime
+import io
+import itertools
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from .models import Activity, Category, Deletion, Station, Tour, TrainRide
+from . import search, views
+# In the root of the repository, which search puts on the path
+import benchmark
+import builder
+import generate_database_fixtures
+import generate_tours
+import transit_db
+
+
+class TourPagesTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title="food", description="")
+        stations = [Station.objects.create(name="Station {}".format(index),
+                                           station_id=index)
+                    for index in range(3)]
+        activities = [Activity.objects.create(category=category,
+                                              train_station=station,
+                                              title="Activity {}".format(index))
+                      for index, station in enumerate(stations)]
+        train_rides = [TrainRide.objects.create(from_station=stations[0],
+                                                to_station=station)
+                       for station in stations[1:]]
+        for index in range(views.tours_per_page * 2 + 5):
+            tour = Tour.objects.create(cost=index,
+                                       duration=datetime.timedelta(hours=1))
+            tour.activities.add(*activities[:index % 3 + 1])
+            tour.train_rides.add(*train_rides[:index % 3])
+
+    def test_index_query_count_is_constant(self):
+        # Tours, then one query per prefetched relation
+        with self.assertNumQueries(5):
+            response = self.client.get('/')
+        self.assertEqual(len(response.context['tours']), views.tours_per_page)
+        after = response.context['next_after']
+        with self.assertNumQueries(5):
+            response = self.client.get('/', {'after': after})
+        self.assertEqual(len(response.context['tours']), views.tours_per_page)
+        self.assertTrue(all(tour.id > after
+                            for tour in response.context['tours']))
+
+    def test_index_last_page(self):
+        response = self.client.get('/', {'after': Tour.objects.order_by('id')[
+            views.tours_per_page * 2 - 1].id})
+        self.assertEqual(len(response.context['tours']), 5)
+        self.assertIsNone(response.context['next_after'])
+
+    def test_index_invalid_page(self):
+        response = self.client.get('/', {'after': 'x'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_tour_query_count(self):
+        tour = Tour.objects.order_by('id').last()
+        with self.assertNumQueries(5):
+            response = self.client.get('/tour/{}/'.format(tour.id))
+        self.assertContains(response, "Activity 0")
+
+
+class TourFilterTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        food = Category.objects.create(title="food", description="")
+        park = Category.objects.create(title="park", description="")
+        cls.stations = [Station.objects.create(name="Station {}".format(index),
+                                               station_id=index)
+                        for index in range(3)]
+        cls.cafe = Activity.objects.create(category=food,
+                                           train_station=cls.stations[0],
+                                           title="Cafe")
+        cls.garden = Activity.objects.create(category=park,
+                                             train_station=cls.stations[1],
+                                             title="Garden")
+        cls.categories = (food, park)
+        for index in range(views.tours_per_page + 10):
+            tour = Tour.objects.create(
+                cost=index * 100,
+                duration=datetime.timedelta(minutes=60 + index % 5 * 30))
+            tour.activities.add(cls.cafe)
+            if index % 2:
+                tour.activities.add(cls.garden)
+
+    def get_json(self, **params):
+        response = self.client.get('/tours/', dict(params, format='json'))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_summary_follows_activities(self):
+        tour = Tour.objects.filter(activities=self.garden).first()
+        self.assertEqual(tour.station_ids, ",{},{},".format(
+            self.stations[0].id, self.stations[1].id))
+        tour.activities.remove(self.garden)
+        tour.refresh_from_db()
+        self.assertEqual(tour.station_ids, ",{},".format(self.stations[0].id))
+
+    def test_cost_and_duration_range(self):
+        tours = self.get_json(min_cost=500, max_cost=1500, max_duration=90)['tours']
+        self.assertTrue(tours)
+        for tour in tours:
+            self.assertTrue(500 <= tour['cost'] <= 1500)
+            self.assertLessEqual(tour['duration'], 90)
+
+    def test_categories_and_stations(self):
+        food, park = self.categories
+        both = self.get_json(category=[food.id, park.id])
+        at_garden = self.get_json(station=self.stations[1].id)
+        for data in (both, at_garden):
+            for tour in data['tours']:
+                self.assertIn("Garden", [x['title'] for x in tour['activities']])
+        self.assertEqual(self.get_json(station=self.stations[2].id)['tours'], [])
+
+    def test_sorted_pages(self):
+        costs = []
+        data = {'next_after': None}
+        while True:
+            params = {'sort': '-cost'}
+            if data['next_after'] is not None:
+                params['after'] = data['next_after']
+            with self.assertNumQueries(2 if 'after' not in params else 3):
+                data = self.get_json(**params)
+            costs.extend(tour['cost'] for tour in data['tours'])
+            if data['next_after'] is None:
+                break
+        self.assertEqual(costs, sorted(Tour.objects.values_list('cost', flat=True),
+                                       reverse=True))
+
+    def test_invalid_filters(self):
+        self.assertEqual(self.client.get('/tours/', {'sort': 'x'}).status_code, 400)
+        self.assertEqual(
+            self.client.get('/tours/', {'min_cost': 'x'}).status_code, 400)
+        self.assertEqual(
+            self.client.get('/tours/', {'start_from': '25:00'}).status_code, 400)
+
+    def test_html(self):
+        response = self.client.get('/tours/', {'category': self.categories[1].id})
+        self.assertContains(response, "Garden")
+        self.assertContains(response, "More tours", count=0)
+
+
+def create_search_data():
+    food = Category.objects.create(title="food", description="")
+    park = Category.objects.create(title="park", description="")
+    stations = [Station.objects.create(name="Station {}".format(index),
+                                       station_id=index)
+                for index in range(2)]
+    TrainRide.objects.create(from_station=stations[0],
+                             to_station=stations[1],
+                             duration=datetime.timedelta(minutes=20),
+                             cost=200)
+    opens = datetime.datetime(1970, 1, 1, 9, tzinfo=datetime.timezone(
+        datetime.timedelta(hours=9)))
+    lunch = Activity.objects.create(
+        category=food, train_station=stations[0], title="Lunch",
+        available_from=opens, available_until=opens + datetime.timedelta(hours=8),
+        duration=datetime.timedelta(hours=1), cost=1000)
+    Activity.objects.create(
+        category=park, train_station=stations[1], title="Park",
+        available_from=opens, available_until=opens + datetime.timedelta(hours=8),
+        duration=datetime.timedelta(hours=2))
+    return lunch
+
+
+class SearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lunch = create_search_data()
+
+    def test_search_is_cached(self):
+        params = {'start': '10:00', 'max_end': '17:00', 'best': 2}
+        data = self.client.get('/search/', params).json()
+        self.assertFalse(data['cached'])
+        self.assertTrue(data['complete'])
+        titles = [event['title'] for event in data['tours'][0]['events']]
+        self.assertIn("Lunch", titles)
+        self.assertIn("Park", titles)
+        self.assertTrue(self.client.get('/search/', params).json()['cached'])
+
+        self.lunch.cost = 5000
+        self.lunch.save()
+        data = self.client.get('/search/', params).json()
+        self.assertFalse(data['cached'])
+        self.assertEqual(data['tours'][0]['cost'], 5200)
+
+    def test_invalid_spec(self):
+        response = self.client.get('/search/', {'score': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_save_during_search(self):
+        # Saves don't wait for a running search, whose results are then
+        # not cached
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with search.search_lock:
+                held.set()
+                release.wait(5)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        held.wait()
+        generation = search.cache.generation
+        started = time.monotonic()
+        try:
+            self.lunch.cost = 5000
+            self.lunch.save()
+        finally:
+            release.set()
+            holder.join()
+        self.assertLess(time.monotonic() - started, 1)
+        search.cache.set('spec', 'tours', generation)
+        self.assertIsNone(search.cache.get('spec'))
+
+
+def search_specs():
+    specs = builder.Specifications(start_time=datetime.time(9, 0))
+    specs.set_max_cost(8000)
+    specs.set_min_end_time(datetime.time(13, 0))
+    specs.set_max_end_time(datetime.time(15, 0))
+    return specs
+
+
+def reference_tours(specs, activities):
+    # The search as builder.py first did it, copying the Tour for each
+    # activity it tried. (path, Tour) pairs in the order they were found.
+    found = []
+
+    def build(tour, path, remaining):
+        remaining = [index for index in remaining
+                     if activities[index].duration < tour.remaining_time()
+                     and activities[index].cost < tour.remaining_money()]
+        for index in remaining:
+            next_tour = copy.copy(tour)
+            next_tour.events = list(tour.events)
+            next_tour.included_meals = dict(tour.included_meals)
+            if next_tour.add_activity(activities[index]):
+                next_path = path + [index]
+                if next_tour.within_spec():
+                    found.append((next_path, next_tour))
+                build(next_tour, next_path,
+                      [other for other in remaining if other != index])
+
+    for index, activity in enumerate(activities):
+        tour = builder.Tour(specs)
+        if tour.add_activity(activity):
+            build(tour, [index],
+                  [other for other in range(len(activities)) if other != index])
+    return found
+
+
+def best_paths(specs, activities, k, score):
+    return [list(path) for path in builder.TourSearch(
+        specs, activities, best=builder.BestTours(k, score),
+        compact=True).run()]
+
+
+class TourSearchTests(SimpleTestCase):
+
+    def setUp(self):
+        self.activities = benchmark.Catalog(12, 4, 1).builder_activities()
+        self.specs = search_specs()
+
+    def test_reference(self):
+        expected = reference_tours(self.specs, self.activities)
+        self.assertGreater(len(expected), 100)
+        paths = builder.TourSearch(self.specs, self.activities,
+                                   compact=True).run()
+        self.assertEqual([list(path) for path in paths],
+                         [path for path, tour in expected])
+        tours = builder.TourSearch(self.specs, self.activities).run()
+        self.assertEqual([tour.as_dict() for tour in tours],
+                         [tour.as_dict() for path, tour in expected])
+
+    def test_durations_in_whole_minutes(self):
+        # 1.33 hours is 79.8 minutes
+        activities = [builder.Activity(
+            title=activity.title, location=activity.location,
+            duration=builder.to_duration("1.33"), cost=activity.cost,
+            available_from=activity.available_from,
+            available_until=activity.available_until,
+            category=activity.category) for activity in self.activities]
+        self.assertEqual(activities[0].minutes, 80)
+        self.assertEqual(activities[0].duration, datetime.timedelta(minutes=80))
+        expected = reference_tours(self.specs, activities)
+        self.assertTrue(expected)
+        tours = builder.TourSearch(self.specs, activities).run()
+        self.assertEqual([tour.as_dict() for tour in tours],
+                         [tour.as_dict() for path, tour in expected])
+
+    def test_dedup(self):
+        # Orderings of the same activities finishing at different times
+        # can't stand in for each other, the activities may not be open
+        # yet or the tour may end too early
+        specs = search_specs()
+        specs.set_min_end_time(datetime.time(15, 0))
+        specs.set_max_end_time(datetime.time(17, 0))
+        activities = benchmark.Catalog(12, 4, 45).builder_activities()
+        paths = [tuple(path) for path in builder.TourSearch(
+            specs, activities, compact=True).run()]
+        tour_search = builder.TourSearch(specs, activities, dedup=True,
+                                         compact=True)
+        dedup = [tuple(path) for path in tour_search.run()]
+        self.assertGreater(tour_search.stats.dominated, 0)
+        self.assertLess(len(dedup), len(paths))
+        self.assertLessEqual(set(dedup), set(paths))
+        self.assertEqual(set(frozenset(path) for path in dedup),
+                         set(frozenset(path) for path in paths))
+
+    def test_best_tours(self):
+        # The k best of all the tours, the first found among equal scores
+        expected = reference_tours(self.specs, self.activities)
+        matrix = builder.get_travel_matrix()
+        compact = [builder.CompactActivity(index, activity)
+                   for index, activity in enumerate(self.activities)]
+        for name, score in sorted(builder.tour_scores.items()):
+            with self.subTest(score=name):
+                ranked = []
+                for found, (path, tour) in enumerate(expected):
+                    compact_tour = builder.CompactTour(self.specs, compact,
+                                                       matrix)
+                    for index in path:
+                        self.assertTrue(compact_tour.add(compact[index]))
+                    ranked.append((score(compact_tour), -found, path))
+                ranked.sort(reverse=True)
+                self.assertEqual(
+                    best_paths(self.specs, self.activities, 10, score),
+                    [entry[2] for entry in ranked[:10]])
+
+    def test_parallel(self):
+        serial = builder.TourSearch(self.specs, self.activities,
+                                    compact=True).run()
+        score = builder.tour_scores['meals']
+        for split_depth in (1, 2):
+            with self.subTest(split_depth=split_depth):
+                parallel = builder.ParallelTourSearch(
+                    self.specs, self.activities, 2, split_depth,
+                    compact=True).run()
+                self.assertEqual(parallel, serial)
+                best = builder.BestTours(10, score)
+                parallel = builder.ParallelTourSearch(
+                    self.specs, self.activities, 2, split_depth, best=best,
+                    compact=True).run()
+                self.assertEqual(
+                    [list(path) for path in parallel],
+                    best_paths(self.specs, self.activities, 10, score))
+
+    @unittest.skipIf(builder.numpy is None, "needs NumPy")
+    def test_vector_bounds(self):
+        activities = benchmark.Catalog(120, 8, 2).builder_activities()
+        specs = benchmark.builder_specs()
+        score = builder.tour_scores['activities']
+
+        def first_paths(best=None):
+            tour_search = builder.TourSearch(specs, activities, best=best)
+            paths = itertools.islice(tour_search.iter_paths(), 500)
+            return type(tour_search.bounds), [list(path) for path in paths]
+
+        vector = first_paths()
+        vector_best = first_paths(builder.BestTours(10, score))
+        with mock.patch.object(builder, 'vector_min_activities',
+                               len(activities) + 1):
+            plain = first_paths()
+            plain_best = first_paths(builder.BestTours(10, score))
+        self.assertIs(vector[0], builder.VectorSearchBounds)
+        self.assertIs(plain[0], builder.SearchBounds)
+        self.assertEqual(len(vector[1]), 500)
+        self.assertEqual(vector[1], plain[1])
+        self.assertEqual(vector_best[1], plain_best[1])
+
+    def test_aiter_tours_closed_early(self):
+        async def first_tours(count):
+            tours = []
+            async with contextlib.aclosing(builder.aiter_tours(
+                    self.specs, self.activities, queue_size=2)) as stream:
+                async for tour in stream:
+                    tours.append(tour.as_dict())
+                    if len(tours) == count:
+                        break
+            return tours
+
+        # Closing waits for the search thread, which has to stop
+        tours = asyncio.run(asyncio.wait_for(first_tours(3), 10))
+        self.assertEqual(tours, [tour.as_dict() for tour in builder.iter_tours(
+            self.specs, self.activities, limit=3)])
+
+    def test_time_limit_without_tours(self):
+        # Nothing is that expensive, so no tour is ever found to stop at
+        activities = benchmark.Catalog(40, 8).builder_activities()
+        specs = builder.Specifications(start_time=datetime.time(8, 0))
+        specs.set_min_cost(40000)
+        specs.set_max_end_time(datetime.time(20, 0))
+        tour_search = builder.TourSearch(
+            specs, activities,
+            best=builder.BestTours(10, builder.tour_scores['activities']))
+        started = time.monotonic()
+        self.assertEqual(tour_search.run(time_limit=0.5), [])
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertFalse(tour_search.complete)
+
+
+class SearchTraceTests(SimpleTestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, builder, 'travel_matrix',
+                        builder.travel_matrix)
+        matrix = builder.TravelMatrix(range(3), ["A", "B", "C"])
+        matrix.set_route(0, 1, 20, 200, 0)
+        builder.travel_matrix = matrix
+
+    def tour(self, start, activities, trace):
+        specs = builder.Specifications(start_time=datetime.time(*start))
+        specs.set_max_cost(2000)
+        specs.set_max_end_time(datetime.time(22, 0))
+        compact = [builder.CompactActivity(index, activity)
+                   for index, activity in enumerate(activities)]
+        return builder.TracedCompactTour(specs, compact,
+                                         builder.get_travel_matrix(),
+                                         trace), compact
+
+    def test_rejections(self):
+        def activity(station, category, opens, closes, minutes, cost=0):
+            return builder.Activity(
+                title=category, location=builder.Station(station),
+                duration=datetime.timedelta(minutes=minutes), cost=cost,
+                available_from=builder.time(*opens),
+                available_until=builder.time(*closes), category=category)
+
+        trace = builder.SearchTrace()
+        tour, (breakfast, second, park, museum, early, dear, far) = self.tour(
+            (9, 0), [activity("A", 'food', (8,), (12,), 30),
+                     activity("A", 'food', (8,), (12,), 30),
+                     activity("A", 'park', (8,), (20,), 10),
+                     activity("A", 'museum', (10,), (17,), 60),
+                     activity("A", 'park', (8,), (9, 30), 60),
+                     activity("A", 'park', (8,), (20,), 30, 5000),
+                     activity("C", 'park', (8,), (20,), 30)], trace)
+        self.assertFalse(tour.add(museum))
+        self.assertFalse(tour.add(early))
+        self.assertFalse(tour.add(dear))
+        self.assertTrue(tour.add(breakfast))
+        self.assertFalse(tour.add(second))
+        self.assertTrue(tour.add(park))
+        self.assertFalse(tour.add(second))
+        with self.assertRaises(LookupError):
+            tour.add(far)
+        # Coffee is only had until 17:00
+        tour, (coffee,) = self.tour(
+            (17, 30), [activity("A", 'coffee', (8,), (20,), 30)], trace)
+        self.assertFalse(tour.add(coffee))
+        self.assertEqual(trace.rejections, {
+            'not open yet': 1, 'closes too soon': 1, 'food in a row': 1,
+            'duplicate meal': 1, 'coffee out of hours': 1, 'over budget': 1,
+            'no route': 1})
+        self.assertEqual(trace.nodes_per_depth, [1, 1])
+
+    def test_search(self):
+        activities = benchmark.Catalog(12, 4, 1).builder_activities()
+        trace = builder.SearchTrace()
+        tour_search = builder.TourSearch(search_specs(), activities,
+                                         compact=True, trace=trace)
+        tour_search.run()
+        self.assertEqual(sum(trace.nodes_per_depth),
+                         tour_search.stats.nodes_explored)
+        self.assertGreater(sum(trace.rejections.values()), 0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.json")
+            trace.dump(path, tour_search.stats)
+            with open(path) as f:
+                data = json.load(f)
+        self.assertEqual(data['stats']['nodes_explored'],
+                         tour_search.stats.nodes_explored)
+        self.assertEqual(data['nodes_per_depth'], trace.nodes_per_depth)
+
+
+class SearchJobTests(TransactionTestCase):
+    # The jobs run in another thread, which has to see the committed data
+
+    def setUp(self):
+        create_search_data()
+
+    def test_job(self):
+        response = self.client.post('/search/jobs/',
+                                    json.dumps({'start': '10:00', 'best': 2}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        data = response.json()
+        search.get_job(data['id']).future.result(timeout=30)
+
+        state = self.client.get(data['url']).json()
+        self.assertEqual(state['status'], 'done')
+        self.assertTrue(state['complete'])
+        self.assertEqual(len(state['tours']), 2)
+
+        response = self.client.get(data['events'])
+        events = b"".join(response.streaming_content).decode()
+        self.assertTrue(events.startswith("event: done\n"))
+
+    def test_invalid_job(self):
+        response = self.client.post('/search/jobs/', {'best': 'x'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/search/jobs/x/').status_code, 404)
+
+
+class SearchJobEventsTests(SimpleTestCase):
+
+    async def test_progress(self):
+        # A job that never runs, changed by hand
+        job = search.SearchJob(search.normalize_spec({}))
+        with search.jobs_lock:
+            search.jobs[job.id] = job
+        self.addCleanup(search.jobs.pop, job.id)
+        response = await self.async_client.get(
+            '/search/jobs/{}/events/'.format(job.id))
+        events = aiter(response.streaming_content)
+
+        async def next_event():
+            return (await asyncio.wait_for(anext(events), 5)).decode()
+
+        event = await next_event()
+        self.assertTrue(event.startswith("event: progress\n"))
+        self.assertIn('"status": "queued"', event)
+        job.update(status='running', tours=[{'cost': 100}])
+        event = await next_event()
+        self.assertTrue(event.startswith("event: progress\n"))
+        self.assertIn('"tours": [{"cost": 100}]', event)
+        job.update(status='done', complete=True)
+        event = await next_event()
+        self.assertTrue(event.startswith("event: done\n"))
+
+
+class TransitDatabaseTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "transit.db")
+        self.cache_path = os.path.join(directory.name, "transit.cache.db")
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE stations "
+                     "(station_id INTEGER, english TEXT, japanese TEXT)")
+        conn.execute("CREATE TABLE routes (from_id INTEGER, to_id INTEGER, "
+                     "mins INTEGER, cost INTEGER, transfers INTEGER)")
+        conn.execute("CREATE TABLE one_way_routes (from_id INTEGER, "
+                     "to_id INTEGER, mins INTEGER, cost INTEGER, "
+                     "transfers INTEGER)")
+        # More stations than fit in one batch, and two named Ueno
+        self.filler = ["Station {}".format(index)
+                       for index in range(transit_db.batch_size + 50)]
+        conn.executemany("INSERT INTO stations VALUES (?, ?, '')",
+                         [(10, "Asakusa"), (20, "Ueno"), (30, "Shibuya"),
+                          (5, "Ueno")] +
+                         [(1000 + index, name)
+                          for index, name in enumerate(self.filler)])
+        # Stored either way round, the first route between two stations
+        # is taken
+        conn.executemany("INSERT INTO routes VALUES (?, ?, ?, ?, ?)",
+                         [(10, 20, 8, 170, 0), (30, 20, 25, 200, 1),
+                          (20, 10, 9, 180, 0), (1000, 1249, 30, 300, 2)])
+        conn.execute("INSERT INTO one_way_routes VALUES (20, 10, 12, 300, 0)")
+        conn.commit()
+        conn.close()
+
+    def database(self):
+        db = transit_db.TransitDatabase(self.path, self.cache_path)
+        self.addCleanup(db.close)
+        return db
+
+    def test_station_ids(self):
+        db = self.database()
+        ids = db.get_station_ids(["Asakusa", "Ueno", "Shibuya", "Nowhere"] +
+                                 self.filler)
+        self.assertEqual(ids.pop("Asakusa"), 10)
+        self.assertEqual(ids.pop("Ueno"), 20)
+        self.assertEqual(ids.pop("Shibuya"), 30)
+        self.assertEqual(ids, {name: 1000 + index
+                               for index, name in enumerate(self.filler)})
+
+    def test_routes(self):
+        db = self.database()
+        self.assertEqual(db.get_routes([(10, 20), (20, 10), (20, 30),
+                                        (30, 20), (10, 30), (1249, 1000)]), {
+            (10, 20): (8, 170, 0),
+            (20, 10): (12, 300, 0),
+            (20, 30): (25, 200, 1),
+            (30, 20): (25, 200, 1),
+            (1249, 1000): (30, 300, 2),
+        })
+
+    def test_travel_matrix(self):
+        db = self.database()
+        names = ["Asakusa", "Ueno", "Shibuya", "Station 0",
+                 self.filler[-1]]
+        full = builder.TravelMatrix.from_database(db)
+        named = builder.TravelMatrix.from_database(db, names)
+        ids = [10, 20, 30, 1000, 1000 + len(self.filler) - 1]
+
+        def routes(matrix):
+            return [matrix.route(matrix.id_to_index[a], matrix.id_to_index[b])
+                    for a in ids for b in ids if a != b]
+
+        self.assertEqual(routes(named), routes(full))
+        self.assertEqual(named.route(named.id_to_index[20],
+                                     named.id_to_index[10]), (12, 300, 0))
+
+    def test_read_only(self):
+        # The indexes go in a cache database, rebuilt when the source changes
+        with mock.patch.object(transit_db.os, 'access', return_value=False):
+            db = self.database()
+            self.assertEqual(db.get_routes([(10, 20)]), {(10, 20): (8, 170, 0)})
+        self.assertTrue(os.path.exists(self.cache_path))
+        with contextlib.closing(sqlite3.connect(self.path)) as conn:
+            self.assertTrue(transit_db.TransitDatabase.missing_indexes(conn))
+            conn.execute("UPDATE routes SET mins = 7 WHERE from_id = 10")
+            conn.commit()
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        with mock.patch.object(transit_db.os, 'access', return_value=False):
+            db = self.database()
+            self.assertEqual(db.get_routes([(10, 20)]), {(10, 20): (7, 170, 0)})
+
+
+class ImportTransitTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.transit_db = os.path.join(directory.name, "transit.db")
+        self.activities = os.path.join(directory.name, "activities.csv")
+        conn = sqlite3.connect(self.transit_db)
+        conn.execute("CREATE TABLE stations "
+                     "(station_id INTEGER, english TEXT, japanese TEXT)")
+        conn.execute("CREATE TABLE routes (from_id INTEGER, to_id INTEGER, "
+                     "mins INTEGER, cost INTEGER, transfers INTEGER)")
+        conn.executemany("INSERT INTO stations VALUES (?, ?, '')",
+                         [(10, "Asakusa"), (20, "Ueno"), (30, "Shibuya")])
+        conn.executemany("INSERT INTO routes VALUES (?, ?, ?, ?, ?)",
+                         [(10, 20, 8, 170, 0), (30, 20, 25, 200, 1)])
+        conn.commit()
+        conn.close()
+        with open(self.activities, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["Place Name", "Train Station", "Station Valid",
+                             "Time at Place (hours)", "Cost (per person)",
+                             "Opens", "Closes", "Category", "Description"])
+            writer.writerow(["Temple", "Asakusa", "Yes", "1.5", "0", "6:00",
+                             "17:00", "cultural", ""])
+            writer.writerow(["Zoo", "Ueno", "Yes", "3", "600", "", "",
+                             "zoo", ""])
+
+    def import_transit(self):
+        call_command('import_transit', transit_db=self.transit_db,
+                     activities=self.activities, stdout=io.StringIO())
+
+    def test_import(self):
+        self.import_transit()
+        self.assertEqual(Station.objects.count(), 3)
+        self.assertEqual(Category.objects.count(), 11)
+        self.assertEqual(TrainRide.objects.count(), 2)
+        ride = TrainRide.objects.get(to_station__name="Shibuya")
+        self.assertEqual(ride.from_station.station_id, 20)
+        self.assertFalse(ride.one_way)
+        self.assertEqual(ride.duration, datetime.timedelta(minutes=25))
+        self.assertEqual((ride.cost, ride.transfers), (200, 1))
+        temple = Activity.objects.get(title="Temple")
+        self.assertEqual(temple.train_station.name, "Asakusa")
+        self.assertEqual(temple.category.title, "cultural")
+        self.assertEqual(temple.duration, datetime.timedelta(minutes=90))
+        self.assertEqual(temple.available_from.astimezone(
+            datetime.timezone(datetime.timedelta(hours=9))).hour, 6)
+
+    def test_import_again(self):
+        self.import_transit()
+        updated_at = dict(TrainRide.objects.values_list('id', 'updated_at'))
+        conn = sqlite3.connect(self.transit_db)
+        conn.execute("UPDATE routes SET cost = 180 WHERE from_id = 10")
+        conn.commit()
+        conn.close()
+        self.import_transit()
+        self.assertEqual(TrainRide.objects.count(), 2)
+        for ride in TrainRide.objects.select_related('from_station',
+                                                     'to_station'):
+            if 10 in (ride.from_station.station_id, ride.to_station.station_id):
+                self.assertEqual(ride.cost, 180)
+                self.assertGreater(ride.updated_at, updated_at[ride.id])
+            else:
+                self.assertEqual(ride.updated_at, updated_at[ride.id])
+
+    def test_one_way_routes(self):
+        self.import_transit()
+        old = TrainRide.objects.create(
+            id=100, from_station=Station.objects.get(station_id=30),
+            to_station=Station.objects.get(station_id=10))
+        conn = sqlite3.connect(self.transit_db)
+        conn.execute("CREATE TABLE one_way_routes (from_id INTEGER, "
+                     "to_id INTEGER, mins INTEGER, cost INTEGER, "
+                     "transfers INTEGER)")
+        conn.execute("INSERT INTO one_way_routes VALUES (20, 10, 12, 170, 1)")
+        conn.commit()
+        conn.close()
+        self.import_transit()
+        self.assertFalse(TrainRide.objects.filter(id=old.id).exists())
+        ride = TrainRide.objects.get(one_way=True)
+        self.assertEqual((ride.from_station.station_id,
+                          ride.to_station.station_id), (20, 10))
+        self.assertEqual(ride.duration, datetime.timedelta(minutes=12))
+
+
+class TrainRideTests(TestCase):
+
+    def setUp(self):
+        self.stations = [Station.objects.create(name="Station {}".format(index),
+                                                station_id=index)
+                         for index in range(2)]
+
+    def test_stored_once(self):
+        ride = TrainRide.objects.create(from_station=self.stations[1],
+                                        to_station=self.stations[0])
+        self.assertEqual(ride.from_station_id, self.stations[0].id)
+        self.assertEqual(ride.directions(),
+                         [(self.stations[0].id, self.stations[1].id),
+                          (self.stations[1].id, self.stations[0].id)])
+        one_way = TrainRide.objects.create(from_station=self.stations[1],
+                                           to_station=self.stations[0],
+                                           one_way=True)
+        self.assertEqual(one_way.directions(),
+                         [(self.stations[1].id, self.stations[0].id)])
+
+    def test_search_matrix(self):
+        TrainRide.objects.create(from_station=self.stations[0],
+                                 to_station=self.stations[1],
+                                 duration=datetime.timedelta(minutes=20),
+                                 cost=200)
+        TrainRide.objects.create(from_station=self.stations[1],
+                                 to_station=self.stations[0],
+                                 duration=datetime.timedelta(minutes=30),
+                                 cost=300, one_way=True)
+        matrix = search.Snapshot().matrix
+        self.assertEqual(matrix.route(0, 1), (20, 200, 0))
+        self.assertEqual(matrix.route(1, 0), (30, 300, 0))
+
+
+class UpdateToursTests(TestCase):
+
+    def setUp(self):
+        self.lunch = create_search_data()
+        self.museum = Activity.objects.create(
+            category=self.lunch.category, train_station=Station.objects.get(
+                station_id=1),
+            title="Museum", available_from=self.lunch.available_from,
+            available_until=self.lunch.available_until,
+            duration=datetime.timedelta(hours=1), cost=500)
+        self.addCleanup(setattr, generate_tours, 'train_rides', None)
+        self.update()
+
+    def update(self):
+        generate_tours.train_rides = None
+        generate_tours.update_tours(generate_tours.load_activities(), 100)
+        return self.stored_tours()
+
+    def regenerate(self):
+        generate_tours.train_rides = None
+        Tour.objects.all().delete()
+        generate_tours.save_tours(generate_tours.generate_tours(
+            generate_tours.load_activities(), 100))
+        return self.stored_tours()
+
+    def stored_tours(self):
+        return sorted(
+            (sorted(tour.activities.values_list('id', flat=True)),
+             sorted(tour.train_rides.values_list('id', flat=True)),
+             tour.cost, tour.duration, tour.available_from,
+             tour.available_until)
+            for tour in Tour.objects.all())
+
+    def test_edit(self):
+        self.lunch.cost = 3000
+        self.lunch.save()
+        ride = TrainRide.objects.get()
+        ride.duration = datetime.timedelta(minutes=45)
+        ride.save()
+        tours = self.update()
+        self.assertIn(3200, [tour[2] for tour in tours])
+        self.assertEqual(tours, self.regenerate())
+
+    def test_delete(self):
+        self.museum.delete()
+        tours = self.update()
+        self.assertNotIn(self.museum.id, sum((tour[0] for tour in tours), []))
+        self.assertEqual(tours, self.regenerate())
+
+        # The slower ride between the stations is taken instead
+        ride = TrainRide.objects.get()
+        slower = TrainRide.objects.create(
+            from_station=ride.to_station, to_station=ride.from_station,
+            duration=datetime.timedelta(minutes=40), cost=100)
+        self.regenerate()
+        ride.delete()
+        tours = self.update()
+        self.assertIn([slower.id], [tour[1] for tour in tours])
+        self.assertEqual(tours, self.regenerate())
+        self.assertFalse(Deletion.objects.exists())
+
+    def test_ids_not_reused(self):
+        last = Tour.objects.latest('id').id
+        Tour.objects.filter(id=last).delete()
+        generate_tours.save_tours(generate_tours.generate_tours(
+            generate_tours.load_activities(), 1))
+        self.assertGreater(Tour.objects.latest('id').id, last)
+
+
+class SymmetricTrainRidesMigrationTests(TransactionTestCase):
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.migrate([('tourbuilder', target)])
+        executor.loader.build_graph()
+        return executor.loader.project_state(
+            [('tourbuilder', target)]).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_merge(self):
+        apps = self.migrate('0003_tour_summary')
+        Station = apps.get_model('tourbuilder', 'Station')
+        TrainRide = apps.get_model('tourbuilder', 'TrainRide')
+        stations = [Station.objects.create(name="Station {}".format(index),
+                                           station_id=index)
+                    for index in range(3)]
+
+        def ride(a, b, minutes):
+            return TrainRide.objects.create(
+                from_station=stations[a], to_station=stations[b],
+                duration=datetime.timedelta(minutes=minutes), cost=200).id
+
+        both_ways = ride(0, 1, 20)
+        ride(1, 0, 20)
+        loop = ride(0, 0, 5)
+        there = ride(1, 2, 10)
+        back = ride(2, 1, 15)
+        apps = self.migrate('0004_symmetric_train_rides')
+        TrainRide = apps.get_model('tourbuilder', 'TrainRide')
+        self.assertEqual(
+            sorted(TrainRide.objects.values_list('id', 'one_way')),
+            [(both_ways, False), (loop, False), (there, False),
+             (back, True)])
+
+
+class SnapshotTests(TestCase):
+
+    def setUp(self):
+        self.lunch = create_search_data()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "tours.snap")
+        generate_tours.write_snapshot(self.path)
+
+    def test_load(self):
+        def fields(activity):
+            return (activity.id, activity.title, activity.cost,
+                    activity.duration, activity.available_from,
+                    activity.available_until, activity.train_station_id,
+                    activity.train_station.name, activity.category.title)
+
+        def ride_fields(rides):
+            return {(a, b): ride and (ride.id, ride.cost, ride.duration)
+                    for a, b in itertools.product(stations, repeat=2)
+                    for ride in [rides.get((a, b))]}
+
+        # Another ride both ways, and one way rides that replace them
+        ride = TrainRide.objects.get()
+        TrainRide.objects.create(from_station=ride.to_station,
+                                 to_station=ride.from_station,
+                                 duration=datetime.timedelta(minutes=25),
+                                 cost=250)
+        for minutes in (30, 35):
+            TrainRide.objects.create(from_station=ride.to_station,
+                                     to_station=ride.from_station,
+                                     duration=datetime.timedelta(
+                                         minutes=minutes),
+                                     cost=300, one_way=True)
+        Station.objects.create(name="Station 2", station_id=2)
+        stations = Station.objects.values_list('id', flat=True)
+        generate_tours.write_snapshot(self.path)
+        activities, rides = generate_tours.load_snapshot(self.path)
+        self.assertEqual([fields(x) for x in activities],
+                         [fields(x) for x in generate_tours.load_activities()])
+        expected = ride_fields(generate_tours.load_train_rides())
+        self.assertEqual(ride_fields(rides), expected)
+        self.assertEqual(len([x for x in expected.values() if x]), 2)
+        matrix = search.builder.SnapshotTravelMatrix(self.path)
+        self.assertEqual(matrix.route(0, 1), (20, 200, 0))
+        self.assertEqual(matrix.route(1, 0), (35, 300, 0))
+
+    def test_out_of_date(self):
+        self.lunch.cost = 1200
+        self.lunch.save()
+        with self.assertRaisesMessage(ValueError, "out of date"):
+            generate_tours.load_snapshot(self.path)
+
+    def test_corrupt(self):
+        with open(self.path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 1]))
+        with self.assertRaisesMessage(ValueError, "corrupt"):
+            generate_tours.load_snapshot(self.path)
+
+
+class BuilderSnapshotTests(SimpleTestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, builder, 'travel_matrix',
+                        builder.travel_matrix)
+        self.activities = benchmark.Catalog(12, 4, 1).builder_activities()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.inputs = []
+        for name in ("activities.csv", "tokyo-transit.db"):
+            self.inputs.append(os.path.join(directory.name, name))
+            with open(self.inputs[-1], 'w') as f:
+                f.write(name)
+        patches = [mock.patch.object(builder, 'path_activities',
+                                     self.inputs[0]),
+                   mock.patch.object(builder, 'path_transit_database',
+                                     self.inputs[1])]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.path = os.path.join(directory.name, "tours.snap")
+        builder.write_snapshot(self.path, self.activities)
+
+    def test_load(self):
+        activities = builder.load_snapshot(self.path)
+        self.assertEqual([(x.title, x.cost, x.duration) for x in activities],
+                         [(x.title, x.cost, x.duration)
+                          for x in self.activities])
+
+    def test_out_of_date(self):
+        for path in self.inputs:
+            with open(path, 'a') as f:
+                f.write("changed")
+            with self.assertRaisesMessage(ValueError, "out of date"):
+                builder.load_snapshot(self.path)
+            self.assertEqual(len(builder.load_snapshot(self.path, False)),
+                             len(self.activities))
+            builder.write_snapshot(self.path, self.activities)
+
+
+class WriteFixturesTests(SimpleTestCase):
+
+    fixtures = [
+        {'model': "tourbuilder.station", 'pk': 1,
+         'fields': {'name': "上野", 'station_id': 20}},
+        {'model': "tourbuilder.activity", 'pk': 2,
+         'fields': {'title': "Zoo", 'cost': 600, 'tags': [], 'extra': {}}},
+    ]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "fixtures")
+
+    def write(self, fixtures, *args):
+        generate_database_fixtures.write_fixtures(self.path, iter(fixtures),
+                                                  *args)
+        with open(self.path) as f:
+            return f.read()
+
+    def test_json(self):
+        self.assertEqual(self.write(self.fixtures),
+                         json.dumps(self.fixtures, indent=2,
+                                    ensure_ascii=False))
+        self.assertEqual(json.loads(self.write(self.fixtures, 'json', None)),
+                         self.fixtures)
+
+    def test_json_lines(self):
+        text = self.write(self.fixtures, 'jsonl')
+        self.assertEqual([json.loads(line) for line in text.splitlines()],
+                         self.fixtures)
+
+    def test_empty(self):
+        self.assertEqual(json.loads(self.write([])), [])
+        self.assertEqual(json.loads(self.write([], 'json', None)), [])
+        self.assertEqual(self.write([], 'jsonl'), "")
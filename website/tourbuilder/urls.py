@@ -4,6 +4,11 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('tours/', views.tours, name='tours'),
+    path('search/', views.search_tours, name='search'),
+    path('search/jobs/', views.search_jobs),
+    path('search/jobs/<str:job_id>/', views.search_job),
+    path('search/jobs/<str:job_id>/events/', views.search_job_events),
     path('tour/<int:tour_id>/', views.tour),
     path('activity/<int:activity_id>/', views.activity),
     path('location/<int:location_id>/', views.location),
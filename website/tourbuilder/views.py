@@ -1,17 +1,262 @@
+import asyncio
+import datetime
+import json
+
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import F, Q
 from django.shortcuts import get_object_or_404, render
-from django.http import HttpResponse
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         JsonResponse, StreamingHttpResponse)
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 # from django.template import loader
 
-from .models import Activity, Location, Station, Tour
+from .models import (Activity, Category, Location, Station, Tour,
+                     category_mask, day_start, tzone)
+from . import search
+
+
+tours_per_page = 20
+tour_relations = ('activities',
+                  'train_rides__from_station',
+                  'train_rides__to_station')
+# Seconds between looks at a job from an event stream served under ASGI,
+# and between the comments that keep a quiet stream open
+job_poll_interval = 0.1
+job_keepalive_interval = 15
 
 
 def index(request):
+    # Keyset pagination, the next page starts after the last tour shown
+    tours = Tour.objects.prefetch_related(*tour_relations).order_by('id')
+    after = request.GET.get('after')
+    if after is not None:
+        try:
+            tours = tours.filter(id__gt=int(after))
+        except ValueError:
+            raise Http404("Invalid page")
+    tours = list(tours[:tours_per_page + 1])
+    next_after = None
+    if len(tours) > tours_per_page:
+        tours = tours[:tours_per_page]
+        next_after = tours[-1].id
+    return render(request, 'tourbuilder/index.html',
+                  {'tours': tours, 'next_after': next_after})
+
+
+tour_sorts = {
+    'cost': ('cost', 'id'),
+    '-cost': ('-cost', '-id'),
+    'duration': ('duration', 'id'),
+    '-duration': ('-duration', '-id'),
+}
+
+
+def parse_start_time(value):
+    time = datetime.datetime.strptime(value, "%H:%M").time()
+    return tzone.localize(datetime.datetime.combine(day_start.date(), time))
+
+
+def filter_tours(params):
+    """Tours matching the filters in params, raises ValueError for
+    invalid filters."""
     tours = Tour.objects.all()
-    return render(request, 'tourbuilder/index.html', {'tours': tours})
+    if params.get('min_cost'):
+        tours = tours.filter(cost__gte=int(params['min_cost']))
+    if params.get('max_cost'):
+        tours = tours.filter(cost__lte=int(params['max_cost']))
+    if params.get('min_duration'):
+        minutes = datetime.timedelta(minutes=int(params['min_duration']))
+        tours = tours.filter(duration__gte=minutes)
+    if params.get('max_duration'):
+        minutes = datetime.timedelta(minutes=int(params['max_duration']))
+        tours = tours.filter(duration__lte=minutes)
+    # Tours that can start somewhere within the window
+    if params.get('start_from'):
+        tours = tours.filter(
+            available_until__gte=parse_start_time(params['start_from']))
+    if params.get('start_until'):
+        tours = tours.filter(
+            available_from__lte=parse_start_time(params['start_until']))
+    categories = params.getlist('category')
+    if categories:
+        mask = category_mask(int(category_id) for category_id in categories)
+        tours = tours.annotate(
+            matched_categories=F('category_mask').bitand(mask))
+        tours = tours.filter(matched_categories=mask)
+    for station_id in params.getlist('station'):
+        tours = tours.filter(
+            station_ids__contains=",{},".format(int(station_id)))
+    return tours
+
+
+def tour_as_dict(tour):
+    return {
+        'id': tour.id,
+        'cost': tour.cost,
+        'duration': int(tour.duration.total_seconds() // 60),
+        'available_from': timezone.localtime(tour.available_from).strftime("%H:%M"),
+        'available_until': timezone.localtime(tour.available_until).strftime("%H:%M"),
+        'activities': [{'id': activity.id, 'title': activity.title}
+                       for activity in tour.activities.all()],
+    }
+
+
+def tours(request):
+    sort = request.GET.get('sort', 'cost')
+    if sort not in tour_sorts:
+        return HttpResponseBadRequest("Unknown sort {}".format(sort))
+    try:
+        tours = filter_tours(request.GET)
+    except ValueError as error:
+        return HttpResponseBadRequest("Invalid filter: {}".format(error))
+    order = tour_sorts[sort]
+    tours = tours.prefetch_related('activities').order_by(*order)
+
+    # Keyset pagination on (sort field, id), continuing after a tour id
+    after = request.GET.get('after')
+    if after is not None:
+        field = order[0].lstrip('-')
+        try:
+            after = int(after)
+        except ValueError:
+            raise Http404("Invalid page")
+        last = Tour.objects.filter(pk=after).values(field).first()
+        if last is None:
+            raise Http404("Invalid page")
+        if order[0].startswith('-'):
+            tours = tours.filter(Q(**{field + '__lt': last[field]}) |
+                                 Q(**{field: last[field], 'id__lt': after}))
+        else:
+            tours = tours.filter(Q(**{field + '__gt': last[field]}) |
+                                 Q(**{field: last[field], 'id__gt': after}))
+
+    tours = list(tours[:tours_per_page + 1])
+    next_after = None
+    if len(tours) > tours_per_page:
+        tours = tours[:tours_per_page]
+        next_after = tours[-1].id
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({'tours': [tour_as_dict(tour) for tour in tours],
+                             'next_after': next_after})
+    next_query = None
+    if next_after is not None:
+        params = request.GET.copy()
+        params['after'] = next_after
+        next_query = params.urlencode()
+    return render(request, 'tourbuilder/tours.html', {
+        'tours': tours,
+        'next_query': next_query,
+        'params': request.GET,
+        'sorts': tour_sorts,
+        'selected_categories': request.GET.getlist('category'),
+        'selected_stations': request.GET.getlist('station'),
+        'categories': Category.objects.order_by('title'),
+        'stations': Station.objects.filter(
+            activity__isnull=False).distinct().order_by('name'),
+    })
+
+
+def search_tours(request):
+    try:
+        spec = search.normalize_spec(request.GET)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    (tours, complete), cached = search.search(spec)
+    return JsonResponse({'tours': tours, 'complete': complete,
+                         'cached': cached})
+
+
+@csrf_exempt
+@require_POST
+def search_jobs(request):
+    params = request.POST
+    try:
+        if request.content_type == 'application/json':
+            params = json.loads(request.body)
+            if not isinstance(params, dict):
+                raise ValueError("Expected a JSON object")
+        spec = search.normalize_spec(params)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    job = search.start_job(spec)
+    url = '/search/jobs/{}/'.format(job.id)
+    return JsonResponse({'id': job.id, 'url': url, 'events': url + 'events/'},
+                        status=202)
+
+
+def get_search_job(job_id):
+    job = search.get_job(job_id)
+    if job is None:
+        raise Http404("No such job")
+    return job
+
+
+def search_job(request, job_id):
+    return JsonResponse(get_search_job(job_id).as_dict())
+
+
+def job_event(state):
+    finished = state['status'] in ('done', 'failed')
+    return "event: {}\ndata: {}\n\n".format(
+        'done' if finished else 'progress', json.dumps(state)), finished
+
+
+def job_events(job):
+    # Waits in its thread, as WSGI servers expect
+    version = None
+    while True:
+        state = job.as_dict()
+        if state['version'] == version:
+            yield ": waiting\n\n"
+        else:
+            version = state['version']
+            event, finished = job_event(state)
+            yield event
+            if finished:
+                return
+        job.wait(version, job_keepalive_interval)
+
+
+async def async_job_events(job):
+    # Polls the job, so waiting holds neither a thread nor the event loop
+    version = None
+    waited = 0
+    while True:
+        state = job.as_dict()
+        if state['version'] != version:
+            version = state['version']
+            event, finished = job_event(state)
+            yield event
+            if finished:
+                return
+            waited = 0
+        elif waited >= job_keepalive_interval:
+            yield ": waiting\n\n"
+            waited = 0
+        await asyncio.sleep(job_poll_interval)
+        waited += job_poll_interval
+
+
+def search_job_events(request, job_id):
+    # Server-sent events, a progress event each time the job changes and
+    # a done event when it has finished. Django only streams async
+    # iterators under ASGI and sync ones under WSGI.
+    job = get_search_job(job_id)
+    if isinstance(request, ASGIRequest):
+        events = async_job_events(job)
+    else:
+        events = job_events(job)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 
 def tour(request, tour_id):
-    tour = get_object_or_404(Tour, pk=tour_id)
+    tour = get_object_or_404(Tour.objects.prefetch_related(*tour_relations),
+                             pk=tour_id)
     return render(request, 'tourbuilder/tour.html', {'tour': tour})
 
 